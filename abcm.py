@@ -19,53 +19,124 @@ import numpy as np
 from numpy.linalg import inv,eigh,eig,norm,pinv
 from constants import M_THZ,TPI,KB,THZ_TO_J,THZ_TO_CM,THZ_TO_MEV
 from ewald import Ewald
-from commonfunc import EigenSolver,MonkhorstPack,tetra_dos
+from commonfunc import EigenSolver,MonkhorstPack,tetra_dos,BondTable,\
+        BCEliminate,ChunkSize,IsHermitian,SparseBlocks,SparseEigenSolver,\
+        SparseBCEliminate,BondOperator,HermitianSolve,BondPhase,BondAssemble,\
+        NeighbourSearch
+from parallel import ParallelSolver
 from itertools import permutations
 from sys import exit
 np.set_printoptions(precision=3,linewidth=200,suppress=True)
 
-def DynBuild(basis,bvec,fc,nn,label,kpts,Ni,Mass,crys=True):
+def DynBuildFull(bonds,bvec,kpts,crys=True,sparse=False,gamma=False,backend=None):
     """
-    Build the dynamical matrix from the short range force constant tensors.
-    basis: ndarray of shape (N,3)
+    Build the full ion+BC matrices from the short range force constant
+    tensors for all k-points at once, i.e., before the BCs are eliminated.
+    See DynBuild for the inputs.
+    return: ndarray of shape (nks,3N,3N)
+        no mass and unit scaling applied; a list of nks csr_matrix if sparse
+    """
+    kpts = np.array(kpts)
+    if kpts.shape == (3,): kpts = np.array([kpts])
+    N = bonds.N; src = bonds.src; dst = bonds.dst; fcb = bonds.fc
+    # convert kpts to Cartesian coordinates if needed
+    kpts = kpts.dot(bvec)*2.*np.pi if crys else kpts*2.*np.pi
+    # OFF-diagonal
+    phase = BondPhase(kpts,bonds.x,gamma) # shape = nks,nbonds
+    if sparse:
+        rows = np.concatenate((src,src)); cols = np.concatenate((src,dst))
+        return [SparseBlocks(np.concatenate((-fcb,p.reshape(-1,1,1)*fcb)),\
+                rows,cols,N) for p in phase]
+    # ON-diagonal -fc, the same for all k-points
+    return BondAssemble(-fcb,fcb,src,dst,phase,N,backend=backend)
+
+def DynBuild(bonds,bvec,kpts,Ni,Mass,crys=True,chunk=None,sparse=False,\
+        bcsolver=None,gamma=False,coulomb=None,backend=None):
+    """
+    Build the dynamical matrix from the short range force constant tensors,
+    i.e., the Hermitian matrix M^-1/2.(R - T.S^-1.Ts).M^-1/2
+    bonds: BondTable
+        n.n. of all basis atoms with the force constant tensors fc set,
+        Unit ==> N/m
     bvec: ndarray of shape (3,3)
         reciprocal lattice vectors
-    fc: list of array N*[fc_i], fc_i.shape = (len(nn_i),3,3)
-        force constant tensors, e.g., output from ConstructFC
-        Unit ==> N/m
-    nn: list of array, N*[nn_i], nn_i.shape = (len(nn_i),3)
-        positions of nearest neighbours
-    label: list of list, len(label) = N, len(label_i) = len(nn_i)
-        label of nearest neighbours in terms of no. of basis
     kpts: ndarray
         if crys: coordinates of reciprocal lattice vectors
         else: in terms of 2pi/alat
+    chunk: int
+        number of k-points assembled and eliminated together. By default,
+        it is set so that the full ion+BC stack takes about 256 MB.
+    sparse: boolean
+        if True, the BCs are NOT eliminated. Return a list of csr_matrix
+        of the full ion+BC matrices scaled by diag(M^-1/2,1) on both sides,
+        whose Schur complement is the dynamical matrix above. See
+        SparseEigenSolver with nion=Ni.
+    bcsolver: string
+        "dense": batched LU of the dense BC-BC blocks of the k-point stack
+        "splu": sparse LU of S for each k-point, for large supercells
+        default is "splu" when there are more than 64 BCs
+    gamma: boolean
+        all kpts are Gamma, real float64 matrices are returned
+    coulomb: function
+        coulomb(start,stop) returns the full ion+BC Coulomb matrices of
+        kpts[start:stop] in the unit of DynBuildFull. They are added to the
+        short range ones before the BCs are eliminated, so there is one
+        elimination per k-point. Only with the dense BC solver.
+    backend: str
+        backend of the dense assembly and elimination, see backends
     """
     kpts = np.array(kpts)
     if kpts.shape == (3,): kpts = np.array([kpts])
-    N = len(basis); nks = len(kpts)
-    dyn = np.zeros((nks,Ni*3,Ni*3),dtype=complex)
-    M_1 = inv(Mass)
-    # convert kpts to Cartesian coordinates if needed
-    kpts = kpts.dot(bvec)*2.*np.pi if crys else kpts*2.*np.pi
-    for q in range(nks):
-        dyn1 = np.zeros((N*3,N*3),dtype=complex) # temperoary
-        for i in range(N):
-            for j in range(len(nn[i])):
-                # With which atom?
-                x = basis[i]-nn[i][j]; ka = label[i][j]
-                # ON-diagonal
-                dyn1[i*3:i*3+3,i*3:i*3+3] -= fc[i][j]
-                # OFF-diagonal
-                dyn1[i*3:i*3+3,ka*3:ka*3+3] += fc[i][j]*np.exp(-1j*np.dot(kpts[q],x))
-        # ABCM matrices
-        R = dyn1[0:Ni*3,0:Ni*3]; S = dyn1[Ni*3:,Ni*3:]
-        T = dyn1[0:Ni*3,Ni*3:]; Ts = dyn1[Ni*3:,0:Ni*3]
+    N = bonds.N; nks = len(kpts)
+    # M^-1/2 on both sides keeps the matrix Hermitian
+    M_12 = 1./np.sqrt(np.diag(Mass))
+    if coulomb != None and (sparse or bcsolver not in (None,"dense")):
+        raise ValueError("coulomb needs the dense BC solver!")
+    if sparse:
+        from scipy.sparse import diags
+        scale = diags(np.concatenate((M_12,np.ones(3*(N-Ni)))))
+        return [(scale*dyn1*scale).tocsr()*M_THZ for dyn1 in \
+                DynBuildFull(bonds,bvec,kpts,crys=crys,sparse=True,gamma=gamma)]
+    if bcsolver == None: bcsolver = "splu" if N-Ni > 64 and coulomb == None else "dense"
+    if bcsolver == "splu":
+        dyn = SparseBCEliminate(DynBuildFull(bonds,bvec,kpts,\
+                crys=crys,sparse=True,gamma=gamma),Ni)
+        return M_12.reshape(-1,1)*dyn*M_12*M_THZ
+    elif bcsolver != "dense":
+        raise ValueError("Unknown BC solver: "+bcsolver)
+    if chunk == None: chunk = ChunkSize(N*3)
+    dyn = np.zeros((nks,Ni*3,Ni*3),dtype=float if gamma else complex)
+    for q in range(0,nks,chunk):
+        dyn1 = DynBuildFull(bonds,bvec,kpts[q:q+chunk],crys=crys,gamma=gamma,\
+                backend=backend)
+        if coulomb != None: dyn1 += coulomb(q,min(q+chunk,nks))
         # ABCM operation
-        tmp = np.dot(inv(S),Ts); dyn[q] = np.dot(M_1, R - np.dot(T,tmp))
+        dyn[q:q+chunk] = M_12.reshape(-1,1)*BCEliminate(dyn1,Ni,backend=backend)*M_12
     # scale it to SI unit, omega^2 not frequency^2 after diagonalisation
     return dyn*M_THZ
 
+def TripleTensor(kind,xj,xk):
+    """
+    Tensors of the three-body terms for unit force constants, see
+    ABCM.__set_triples.
+    kind: int array of shape (n,)
+    xj,xk: ndarrays of shape (n,3)
+        bond vectors bas[i]-nn[i][j] and bas[i]-nn[i][k]
+    return: ndarray of shape (n,3,3)
+    """
+    dx = xk-xj # nn[i][j]-nn[i][k]
+    # c*u(x)v/|d1|/|d2| for each kind: c,u,v,d1,d2
+    table = {1:(4,dx,xk,xk,dx), 2:(-4,-dx,xj,xj,dx), 3:(-4,xj,xk,xj,xk),
+            4:(2,xj+xk,-xk,xj,xk), 5:(2,-dx,dx-xj,xj,dx), 6:(2,xk,dx,xk,dx),
+            7:(2,xj+xk,-xk,xj,xk)}
+    unit = np.zeros((len(kind),3,3))
+    for n,(c,u,v,d1,d2) in table.items():
+        m = kind == n
+        if not m.any(): continue
+        d = norm(d1[m],axis=-1)*norm(d2[m],axis=-1)
+        unit[m] = c*u[m,:,np.newaxis]*v[m,np.newaxis,:]/d[:,np.newaxis,np.newaxis]
+    return unit
+
 class ABCM(object):
     """
     Adiabatic Bond-Charge takes inputs:
@@ -78,14 +149,15 @@ class ABCM(object):
     symbol: string array or list, (N,)
         Element names of the basis, e.g., ["Si","Si","BC","BC","BC","BC"]
     """
+    # solve_dyn falls back to eig if the matrices are not Hermitian, see
+    # __is_herm, so the eigenvectors can be complex even at Gamma
+    real_evec = False
     def __init__(self,lvec,basis,mass,symbol):
         self.lvec,self.bas,self.mass,self.symbol =\
                     map(np.array,(lvec,basis,mass,symbol))
         assert self.lvec.shape == (3,3)
         assert len(self.bas) == len(symbol)
 
-        # initialise the force constant tensors
-        self.fc = []
         # initialise the k-points
         self.kpts = []
         # initialise the dynamical matrix
@@ -119,8 +191,34 @@ class ABCM(object):
         self.n1 = [len(self.nn[i]) for i in range(self.N) ]
         # initiate Ewald object
         self.set_ewald()
+        # serial k-point loop unless set_parallel() is called
+        self.set_parallel(nproc=1)
+        # dense or sparse BC elimination chosen by the system size
+        self.set_bc_solver()
+
+    def set_parallel(self,nproc=None,chunk=None):
+        """
+        Build and diagonalise the dynamical matrices in worker processes.
+        nproc: int
+            number of processes, default is the number of cores;
+            nproc=1 switches back to the serial calculation
+        chunk: int
+            number of k-points per task
+        The dynamical matrices are not gathered in parallel runs, so
+        self.dyn is None afterwards.
+        """
+        self.nproc = nproc; self.kchunk = chunk
+
+    def set_bc_solver(self,bcsolver=None):
+        """
+        Choose how the BCs are eliminated, see DynBuild.
+        bcsolver: string
+            "dense", "splu" or None for automatic choice
+        """
+        self.bcsolver = bcsolver
 
-    def set_ewald(self,charge=[],eps=None,rgrid=[3,3,3],kgrid=[3,3,3]):
+    def set_ewald(self,charge=[],eps=None,rgrid=[3,3,3],kgrid=[3,3,3],accuracy=None,
+            method="ewald",single_pass=False):
         """
         ecalc: Ewald object
             Needed when one wants to have this long range interaction
@@ -129,6 +227,19 @@ class ABCM(object):
             of e^2/(4PI*epsilon*alat**3)
         rgrid,kgrid: list
             Meshes for Ewald calculation.
+        accuracy: float
+            if given, e.g., 1e-8, spherical meshes for the Ewald sums
+            are chosen for this accuracy instead of rgrid and kgrid
+        method: str
+            "ewald" or "spme" for the smooth particle-mesh Ewald, which is
+            cheaper for big supercells, see Ewald.get_dyn
+        single_pass: boolean
+            if True, the Coulomb matrices of ions and BCs are added to the
+            short range ones before the BCs are eliminated, i.e., the BCs
+            relax in the total field, with one elimination per k-point.
+            This is a different model: by default the short range and
+            the Coulomb parts are eliminated separately, for which the
+            eps in the literature are fitted. Needs the dense BC solver.
         """
         if (charge != [] and eps == None) or (charge == [] and eps != None):
             raise ValueError("Both charge and eps should be given!")
@@ -136,8 +247,10 @@ class ABCM(object):
             self.ecalc = None; self.eps = None
         else:
             self.ecalc = Ewald(lvec=self.lvec, basis=self.bas, charge=charge, \
-                    rgrid=rgrid, kgrid=kgrid)
+                    rgrid=rgrid, kgrid=kgrid, accuracy=accuracy)
+            self.ecalc.method = method
             self.eps = eps
+        self.single_pass = single_pass
 
     def set_nn(self,scope=[1,1,1],nmax=20,dist2=None,showDist=False):
         """
@@ -158,43 +271,98 @@ class ABCM(object):
             To inspect all bond-lengths of all n.n. upto nmax. Recommended
             for the first run.
         """
-        X,Y,Z = scope
-        x,y,z = np.mgrid[-X:X+1, -Y:Y+1, -Z:Z+1]
-        x = x.reshape(-1); y = y.reshape(-1); z = z.reshape(-1)
-        xyz = np.asarray((x,y,z)).T; rgrid = xyz.dot(self.lvec) # fix this hidden bug
-        # allatoms = []
-        # for item in self.bas:
-        #     allatoms = item+rgrid if allatoms == [] \
-        #         else np.vstack((allatoms,item+rgrid))
-        # the most efficient way to get allatoms
-        allatoms = (self.bas.reshape(-1,1,3)+rgrid).reshape(-1,3)
-        self.label = []; self.nn = []; self.nndist = []
-        for i in range(self.N):
-            dist = norm(self.bas[i]-allatoms,axis=1)
-            nn_ind = dist.argsort()[1:nmax] # consider the first nmax n.n.
-            if showDist: print dist[nn_ind]
-            nn_cut0 = self.nn_cut
-            if self.nn_cut>nmax-1:
-                # you probably have interface problems
-                print "You might need to inspect the nearest neighbours \
-                and need to set a reasonable dist2."
-                nn_cut0 = nmax-1
-
-            if dist2 == None:
-                first_nn_ind = nn_ind[0:nn_cut0]
-            else:
-                # if dist2 exisits, count till that distance
-                first_nn_ind = nn_ind[dist[nn_ind]<=dist2]
-
-            label = np.array(first_nn_ind)/len(rgrid)
-            nn = allatoms[first_nn_ind]
-            nndist = dist[first_nn_ind]
-            self.label.append(label)
-            self.nn.append(nn)
-            self.nndist.append(nndist)
-        self.nnsymb = []
-        for i in range(self.N):
-            self.nnsymb.append(self.symbol[self.label[i]])
+        # candidates of all atoms from one KD-tree query
+        alldist,allind,allatoms,nimg = NeighbourSearch(self.bas,self.lvec,scope,nmax)
+        if showDist:
+            for dist in alldist: print dist
+        nn_cut0 = self.nn_cut
+        if self.nn_cut>nmax-1:
+            # you probably have interface problems
+            print "You might need to inspect the nearest neighbours \
+            and need to set a reasonable dist2."
+            nn_cut0 = nmax-1
+        if dist2 == None:
+            first_nn = np.arange(alldist.shape[1]) < nn_cut0
+            first_nn = np.repeat(first_nn[np.newaxis],self.N,axis=0)
+        else:
+            # if dist2 exisits, count till that distance
+            first_nn = alldist<=dist2
+        offsets = np.concatenate(([0],np.cumsum(first_nn.sum(axis=1))))
+        ind = allind[first_nn]
+        self.bonds = BondTable(self.bas,self.lvec,self.symbol,offsets,ind/nimg,allatoms[ind])
+        self.__set_triples()
+
+    def __set_triples(self):
+        """
+        Classify the pairs (j,k) of n.n. of each atom i by their three-body
+        interaction in set_fc, and keep the tensors of the centre and the
+        three-body terms for unit force constants.
+        kind 1-3: cross-stretching with the BC at k, j or i
+        kind 4-6: BC-bond-bending with the ion at i, j or k
+        kind 7: ion-bond-bending
+        """
+        b = self.bonds
+        x = b.x; d = b.dist[:,np.newaxis,np.newaxis]
+        centre = -8*x[:,:,np.newaxis]*x[:,np.newaxis,:]/d/d
+        j,k = b.pairs()
+        xj = x[j]; xk = x[k]; dx = xk-xj # bas[i]-nn[i][j], bas[i]-nn[i][k], nn[i][j]-nn[i][k]
+        site = 4*self.isBC[b.src[j]]+2*self.isBC[b.dst[j]]+self.isBC[b.dst[k]]
+        inline = norm(np.cross(xj,xk),axis=-1)<1e-6
+        same = lambda r1,r2: np.abs(norm(r1,axis=-1)-norm(r2,axis=-1))<1e-4 # same bond length
+        kind = np.zeros(len(j),dtype=int)
+        kind[(site==1) & inline] = 1
+        kind[(site==2) & inline] = 2
+        kind[(site==4) & inline] = 3
+        kind[(site==3) & same(xj,xk)] = 4
+        kind[(site==5) & same(xj,dx)] = 5
+        kind[(site==6) & same(xk,dx)] = 6
+        kind[(site==0) & same(xj,xk)] = 7
+        keep = kind > 0
+        j,k,kind = j[keep],k[keep],kind[keep]
+        self.triples = j,k,kind
+        self.unit_fc = centre,TripleTensor(kind,xj[keep],xk[keep])
+
+    # per-atom views of self.bonds, e.g., self.nn[i] are the positions of
+    # the n.n. of atom i
+    @property
+    def nn(self):
+        return self.bonds.per_atom("nn")
+
+    @property
+    def label(self):
+        return self.bonds.per_atom("dst")
+
+    @property
+    def nndist(self):
+        return self.bonds.per_atom("dist")
+
+    @property
+    def nnsymb(self):
+        return self.bonds.per_atom("symb")
+
+    @property
+    def fc(self):
+        return [] if self.bonds.fc is None else self.bonds.per_atom("fc")
+
+    @fc.setter
+    def fc(self,fc):
+        if len(fc) == 0: self.bonds.fc = None
+        else: self.bonds.set_fc(fc)
+
+    def __setstate__(self,state):
+        # objects pickled before the bond table keep the per-atom lists nn,
+        # label and fc, and lack the settings added since
+        state = dict(state)
+        if "bonds" not in state:
+            for key in ("nndist","nnsymb"): state.pop(key,None)
+            fc = state.pop("fc",[])
+            state["bonds"] = BondTable.from_lists(state["bas"],state["lvec"],state["symbol"],\
+                    state.pop("nn"),state.pop("label"))
+            if len(fc) != 0: state["bonds"].set_fc(list(fc))
+        for key,value in (("nproc",1),("kchunk",None),("bcsolver",None),("single_pass",False)):
+            state.setdefault(key,value)
+        self.__dict__.update(state)
+        if "triples" not in state: self.__set_triples()
 
     def set_fc(self,fc_dict):
         '''
@@ -228,7 +396,7 @@ class ABCM(object):
             self.alpha = True
         except KeyError:
             print "Warning: 'alpha' key have been skipped."
-            self.alpha = False
+            self.alpha = False; a_dict = {}
         try:
         # if fc_dict.has_key("beta"):
             b_dict = fc_dict["beta"]
@@ -238,7 +406,7 @@ class ABCM(object):
             self.beta = True
         except KeyError:
             print "Warning: 'beta' key have been skipped."
-            self.beta = False
+            self.beta = False; b_dict = {}
         try:
         # if fc_dict.has_key("sigma"):
             s_dict = fc_dict["sigma"]
@@ -248,131 +416,90 @@ class ABCM(object):
             self.sigma = True
         except KeyError:
             print "Warning: 'sigma' keys have been skipped."
-            self.sigma = False
+            self.sigma = False; s_dict = {}
 
         self.fc_dict = fc_dict
-
-        for i in range(self.N):
-            onsite = self.symbol[i]
-            offsite = self.nnsymb[i]
-            nos = len(offsite)
-            # initialise FC tensors
-            FC = np.zeros((nos,3,3))
-            for j in range(nos):
-                sig = 0.0
-                key1 = onsite+"-"+offsite[j]
-                key2 = offsite[j]+"-"+onsite
-                if a_dict.has_key(key1):
-                    alp = a_dict[key1]
-                    if self.sigma:
-                        if s_dict.has_key(key1): sig = s_dict[key1]
-                    FC[j] += self.get_centre_fc(alp,i,j,sig)
-                elif a_dict.has_key(key2):
-                    alp = a_dict[key2]
-                    if self.sigma:
-                        if s_dict.has_key(key2): sig = s_dict[key2]
-                    FC[j] += self.get_centre_fc(alp,i,j,sig)
-
-                for k in range(nos):
-                    if k != j:
-                        inline = (norm(np.cross(self.bas[i]-self.nn[i][j], self.bas[i]-self.nn[i][k]))<1e-6)
-                        if onsite != "BC" and offsite[j]!="BC" and offsite[k]=="BC" and inline: # cross-stretching
-                            key1 = onsite+"-"+"BC"+"-"+offsite[j]
-                            key2 = offsite[j]+"-"+"BC"+"-"+onsite
-                            if a_dict.has_key(key1):
-                                alp = a_dict[key1]; FC[j] += self.get_noncentre_fc(alp,i,j,k,1)
-                            elif a_dict.has_key(key2):
-                                alp = a_dict[key2]; FC[j] += self.get_noncentre_fc(alp,i,j,k,1)
-                            # else:
-                            #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite != "BC" and offsite[j]=="BC" and offsite[k]!="BC" and inline: # cross-stretching
-                            key1 = onsite+"-"+"BC"+"-"+offsite[k]
-                            key2 = offsite[k]+"-"+"BC"+"-"+onsite
-                            if a_dict.has_key(key1):
-                                alp = a_dict[key1]; FC[j] += self.get_noncentre_fc(alp,i,j,k,2)
-                            elif a_dict.has_key(key2):
-                                alp = a_dict[key2]; FC[j] += self.get_noncentre_fc(alp,i,j,k,2)
-                            # else:
-                            #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite == "BC" and offsite[j]!="BC" and offsite[k]!="BC" and inline: #cross-stretching
-                            key1 = offsite[j]+"-"+"BC"+"-"+offsite[k]
-                            key2 = offsite[k]+"-"+"BC"+"-"+offsite[j]
-                            if a_dict.has_key(key1):
-                                alp = a_dict[key1]; FC[j] += self.get_noncentre_fc(alp,i,j,k,3)
-                            elif a_dict.has_key(key2):
-                                alp = a_dict[key2]; FC[j] += self.get_noncentre_fc(alp,i,j,k,3)
-                            # else:
-                            #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite != "BC" and offsite[j]=="BC" and offsite[k]=="BC": # BC-bond-bending
-                            r1 = self.bas[i]-self.nn[i][j]; r2 = self.bas[i]-self.nn[i][k]
-                            if abs(norm(r1)-norm(r2))<1e-4: # same bond length
-                                sig = 0.0
-                                key1 = "BC"+"-"+onsite
-                                key2 = onsite+"-"+"BC"
-                                if b_dict.has_key(key1):
-                                    bet = b_dict[key1]; key1 += "-BC"
-                                    if self.sigma:
-                                        if s_dict.has_key(key1): sig = s_dict[key1]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,1,sig)
-                                elif b_dict.has_key(key2):
-                                    bet = b_dict[key2]; key2 = "BC-"+key2
-                                    if self.sigma:
-                                        if s_dict.has_key(key2): sig = s_dict[key2]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,1,sig)
-                                # else:
-                                #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite == "BC" and offsite[j]!="BC" and offsite[k]=="BC": # BC-bond-bending
-                            r1 = self.nn[i][j]-self.bas[i]; r2 = self.nn[i][j]-self.nn[i][k]
-                            if abs(norm(r1)-norm(r2))<1e-4: # same bond length
-                                sig = 0.0
-                                key1 = "BC"+"-"+offsite[j]
-                                key2 = offsite[j]+"-"+"BC"
-                                if b_dict.has_key(key1):
-                                    bet = b_dict[key1]; key1 += "-BC"
-                                    if self.sigma:
-                                        if s_dict.has_key(key1): sig = s_dict[key1]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,2,sig)
-                                elif b_dict.has_key(key2):
-                                    bet = b_dict[key2]; key2 = "BC-"+key2
-                                    if self.sigma:
-                                        if s_dict.has_key(key2): sig = s_dict[key2]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,2,sig)
-                                # else:
-                                #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite == "BC" and offsite[j]=="BC" and offsite[k]!="BC": # BC-bond-bending
-                            r1 = self.nn[i][k]-self.bas[i]; r2 = self.nn[i][k]-self.nn[i][j]
-                            if abs(norm(r1)-norm(r2))<1e-4: # same bond length
-                                sig = 0.0
-                                key1 = "BC"+"-"+offsite[k]
-                                key2 = offsite[k]+"-"+"BC"
-                                if b_dict.has_key(key1):
-                                    bet = b_dict[key1]; key1 += "-BC"
-                                    if self.sigma:
-                                        if s_dict.has_key(key1): sig = s_dict[key1]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,3,sig)
-                                elif b_dict.has_key(key2):
-                                    bet = b_dict[key2]; key2 = "BC-"+key2
-                                    if self.sigma:
-                                        if s_dict.has_key(key2): sig = s_dict[key2]
-                                    FC[j] += self.get_bending_fc(bet,i,j,k,3,sig)
-                                # else:
-                                #     raise ValueError("Missing interaction: "+key1)
-                        elif onsite!="BC" and offsite[j]!="BC" and offsite[k]!="BC": # ion-bod-bending
-                            r1 = self.bas[i]-self.nn[i][j]; r2 = self.bas[i]-self.nn[i][k]
-                            if abs(norm(r1)-norm(r2))<1e-4: # same bond length
-                                keys = list(permutations([onsite,offsite[j],offsite[k]]))
-                                for item in keys:
-                                    key = item[0]+"-"+item[1]+"-"+item[2]
-                                    if b_dict.has_key(key):
-                                        bet = b_dict[key]; FC[j] += self.get_bending_fc(bet,i,j,k,1)
-                                        break
-                        else:
-                            pass
-                #
-            #
-            self.fc.append(FC)
+        self.fc = self.__build_fc(a_dict,b_dict,s_dict)
         # self.fix_interface()
 
+    def fc_basis(self,fc_dict):
+        """
+        The force constants of set_fc are linear in the values of fc_dict,
+        so they are the weighted sum of the tables of unit values, e.g.,
+        calc.fc = np.tensordot(values,basis,1).
+        fc_dict: dictionary
+            see set_fc, only the keys are used
+        return: keys,basis
+            keys: list of ("alpha"|"beta"|"sigma",key) in the order of
+            fc_dict[...].keys(); basis: ndarray of shape (len(keys),nbonds,3,3)
+        """
+        names = ("alpha","beta","sigma")
+        dicts = [fc_dict.get(name,{}) for name in names]
+        keys = [(name,key) for name,d in zip(names,dicts) for key in d.keys()]
+        basis = np.zeros((len(keys),len(self.bonds),3,3))
+        for n,(name,key) in enumerate(keys):
+            unit = [dict.fromkeys(d,0.) for d in dicts]
+            unit[names.index(name)][key] = 1.
+            basis[n] = self.__build_fc(*unit)
+        return keys,basis
+
+    def __build_fc(self,a_dict,b_dict,s_dict):
+        # the force constant tables of all bonds, see set_fc
+        b = self.bonds
+        names = [str(name) for name in b.names]; ns = len(names)
+        on = b.codes[b.src]
+        # the centre terms, with the parameters looked up once for each
+        # pair of species
+        pair = on*ns+b.species
+        alp = np.zeros(ns*ns); sig = np.zeros(ns*ns)
+        for p in np.unique(pair):
+            alp[p],sig[p] = self.__centre_param(names[p//ns],names[p%ns],a_dict,s_dict)
+        centre,unit = self.unit_fc
+        fc = centre*alp[pair][:,np.newaxis,np.newaxis] \
+                + sig[pair][:,np.newaxis,np.newaxis]*np.identity(3)
+        # the three-body terms of the bond pairs (j,k), looked up once for
+        # each kind and triple of species
+        j,k,kind = self.triples
+        combo = ((kind*ns+on[j])*ns+b.species[j])*ns+b.species[k]
+        uniq,inv = np.unique(combo,return_inverse=True)
+        par = np.zeros((len(uniq),2))
+        for n,item in enumerate(uniq):
+            item,sk = divmod(item,ns); item,sj = divmod(item,ns); kd,si = divmod(item,ns)
+            par[n] = self.__triple_param(kd,names[si],names[sj],names[sk],a_dict,b_dict,s_dict)
+        sig = par[inv,1]*np.array([0,0,0,0,-1,-1,1,0])[kind]
+        terms = unit*par[inv,0][:,np.newaxis,np.newaxis] \
+                + sig[:,np.newaxis,np.newaxis]*np.identity(3)
+        # j is sorted, so the terms of each bond are contiguous
+        if len(j):
+            first = np.concatenate(([True],j[1:] != j[:-1]))
+            fc[j[first]] += np.add.reduceat(terms,np.nonzero(first)[0])
+        return fc
+
+    def __centre_param(self,on,oj,a_dict,s_dict):
+        # alpha and sigma of the centre term of on-oj bonds
+        for key in (on+"-"+oj,oj+"-"+on):
+            if a_dict.has_key(key):
+                return a_dict[key],s_dict.get(key,0.)
+        return 0.,0.
+
+    def __triple_param(self,kind,on,oj,ok,a_dict,b_dict,s_dict):
+        # alpha or beta, and sigma of the three-body term of the given kind,
+        # see __set_triples, for atom i of species on with the n.n. j and k
+        if kind <= 3: # cross-stretching
+            ions = [(on,oj),(on,ok),(oj,ok)][kind-1]
+            for key in (ions[0]+"-BC-"+ions[1],ions[1]+"-BC-"+ions[0]):
+                if a_dict.has_key(key): return a_dict[key],0.
+        elif kind <= 6: # BC-bond-bending
+            ion = [on,oj,ok][kind-4]
+            for key in ("BC-"+ion,ion+"-BC"):
+                if b_dict.has_key(key):
+                    return b_dict[key],s_dict.get("BC-"+ion+"-BC",0.)
+        else: # ion-bond-bending
+            for item in permutations([on,oj,ok]):
+                key = "-".join(item)
+                if b_dict.has_key(key): return b_dict[key],0.
+        return 0.,0.
+
     def get_centre_fc(self,a,i,j,s=0):
         """
         generate ion-ion centre force constant tensor
@@ -380,69 +507,40 @@ class ABCM(object):
         i: integer, onsite ion index
         j: integer, offsite ion index
         """
-        dvec = (self.bas[i]-self.nn[i][j]); d = norm(dvec)
-        one = np.ones((3,3)); tmp = dvec*one
-        return -np.multiply(tmp,tmp.T)*a/d/d*8 + s*np.identity(3)
+        return self.unit_fc[0][self.bonds.offsets[i]+j]*a + s*np.identity(3)
 
     def get_bending_fc(self,b,i,j,k,ionsite,s=0):
-        one = np.ones((3,3))
-        if ionsite == 1: # i sits an ion
-            dvec1 = (self.bas[i]-self.nn[i][j]); d1 = norm(dvec1)
-            dvec2 = (self.bas[i]-self.nn[i][k]); d2 = norm(dvec2)
-            tmp1 = (dvec1+dvec2)*one; tmp2 = -dvec2*one
-            return 2*np.multiply(tmp1.T,tmp2)*b/d1/d2 - s*np.identity(3)
-        elif ionsite == 2: # j sits an ion
-            dvec1 = self.nn[i][j]-self.bas[i]; d1 = norm(dvec1)
-            dvec2 = self.nn[i][j]-self.nn[i][k]; d2 = norm(dvec2)
-            tmp1 = (dvec1+dvec2)*one; tmp2 = -dvec2*one
-            return 2*np.multiply(tmp1,tmp2.T)*b/d1/d2 - s*np.identity(3)
-        elif ionsite == 3: # k sits an ion
-            dvec1 = self.bas[i]-self.nn[i][k]; d1 = norm(dvec1) # BC-ION
-            dvec2 = self.nn[i][j]-self.nn[i][k]; d2 = norm(dvec2) # BC-ION
-            tmp1 = one*dvec1; tmp2 = (one*dvec2)
-            return 2*np.multiply(tmp1.T,tmp2)*b/d1/d2 + s*np.identity(3)
-        else:
-            return 0
+        """
+        bond-bending tensor of the n.n. j and k of atom i, with the ion at
+        i, j or k for ionsite 1, 2 or 3 (kind 4-6 of __set_triples)
+        """
+        if ionsite not in (1,2,3): return 0
+        return self.__triple_fc(ionsite+3,i,j,k)*b + (-1,-1,1)[ionsite-1]*s*np.identity(3)
 
     def get_noncentre_fc(self,a,i,j,k,bcsite):
-        one = np.ones((3,3))
-        if bcsite == 1: # k sits a BC
-            dvec1 = (self.bas[i]-self.nn[i][k]); d1 = norm(dvec1)
-            dvec2 = (self.nn[i][j]-self.nn[i][k]); d2 = norm(dvec2)
-            tmp1 = one*dvec1; tmp2 = (one*dvec2)
-            return 4*tmp1*tmp2.T*a/d1/d2
-        if bcsite == 2: # j sits a BC
-            dvec1 = (self.bas[i]-self.nn[i][j]); d1 = norm(dvec1)
-            dvec2 = (self.nn[i][k]-self.nn[i][j]); d2 = norm(dvec2)
-            tmp1 = one*dvec1; tmp2 = (one*dvec2)
-            return -4*tmp1*tmp2.T*a/d1/d2
-        if bcsite == 3: # i sits a BC
-            dvec1 = (self.bas[i]-self.nn[i][j]); d1 = norm(dvec1)
-            dvec2 = (self.bas[i]-self.nn[i][k]); d2 = norm(dvec2)
-            tmp1 = one*dvec1; tmp2 = (one*dvec2)
-            return -4*tmp1.T*tmp2*a/d1/d2
-        else:
-            return 0
+        """
+        cross-stretching tensor of the n.n. j and k of atom i, with the BC
+        at k, j or i for bcsite 1, 2 or 3 (kind 1-3 of __set_triples)
+        """
+        if bcsite not in (1,2,3): return 0
+        return self.__triple_fc(bcsite,i,j,k)*a
+
+    def __triple_fc(self,kind,i,j,k):
+        x = self.bonds.x[self.bonds.offsets[i]+np.array([j,k])]
+        return TripleTensor(np.array([kind]),x[:1],x[1:])[0]
 
     def fix_interface(self):
-        # Average the interface connection for set_fc()
-        for i in range(self.N):
-            print "Checking atom ",i
-            for j in range(len(self.nn[i])):
-                bond0 = self.bas[i] - self.nn[i][j]
-                offsiteLabel = self.label[i][j]
-                for k in range(len(self.nn[offsiteLabel])):
-                    bond1 = self.bas[offsiteLabel] - self.nn[offsiteLabel][k]
-                    if np.allclose(bond0,-bond1): # the same bond
-                        tmp = self.fc[i][j] + self.fc[offsiteLabel][k].T
-                        if np.allclose(self.fc[i][j],self.fc[offsiteLabel][k].T):
-                            print self.symbol[i]," with ", self.nnsymb[i][j], " is fine"
-                        else:
-                            print self.symbol[i]," with ", self.nnsymb[i][j], " is not fine"
-                            print self.fc[i][j]-self.fc[offsiteLabel][k].T
-                        tmp *= 0.5
-                        self.fc[i][j] = tmp
-                        self.fc[offsiteLabel][k] = tmp.T
+        # Average the interface connection for set_fc(), i.e., the fc of
+        # each bond and the transpose of that of its reverse bond
+        fc = self.bonds.fc
+        rev = self.bonds.reverse(); both = rev >= 0
+        fcr = np.swapaxes(fc[rev[both]],1,2)
+        fine = np.all(np.isclose(fc[both],fcr),axis=(1,2))
+        print "%d of %d bonds are fine" % (fine.sum(),len(fine))
+        for b,diff in zip(np.nonzero(both)[0][~fine],(fc[both]-fcr)[~fine]):
+            print self.symbol[self.bonds.src[b]]," with ", self.bonds.symb[b], " is not fine"
+            print diff
+        fc[both] = 0.5*(fc[both]+fcr)
 
     def set_kpts(self,kpts,crys=True):
         """
@@ -494,10 +592,61 @@ class ABCM(object):
             raise ValueError("Force constants not set yet!")
         elif self.kpts == []:
             raise ValueError("Kpts not set yet!")
-        self.dyn = DynBuild(self.bas,self.bvec,self.fc,\
-                self.nn,self.label,self.kpts,self.N_ion,self.Mass,crys=self.iskcrys)
+        self.dyn = self.build_dyn(self.kpts,self.iskcrys)
+
+    def build_dyn(self,kpts,crys=True):
+        """
+        Return the dynamical matrix, short range plus Ewald, at kpts
+        without touching self.kpts and self.dyn. It is real if all kpts
+        are Gamma, so that the real symmetric eigensolver is used.
+        """
+        gamma = not np.any(kpts)
+        if self.ecalc != None and self.single_pass:
+            def coulomb(start,stop):
+                # one extra k-point on each side for the direction of
+                # approach at Gamma, see Ewald.get_dyn
+                lo = max(start-1,0); hi = min(stop+1,len(kpts))
+                return self.eps*self.ecalc.get_dyn(self.mass,kpts[lo:hi],crys=crys,\
+                        mode="full",gamma=gamma)[start-lo:stop-lo]
+            return DynBuild(self.bonds,self.bvec,kpts,self.N_ion,self.Mass,crys=crys,\
+                    bcsolver=self.bcsolver,gamma=gamma,coulomb=coulomb)
+        dyn = DynBuild(self.bonds,self.bvec,kpts,self.N_ion,self.Mass,crys=crys,\
+                bcsolver=self.bcsolver,gamma=gamma)
+        if self.ecalc != None:
+            dyn += self.eps*self.ecalc.get_dyn(self.mass,kpts,crys=crys,mode="abcm",\
+                    gamma=gamma)
+        return dyn
+
+    def solve_dyn(self,dyn,evec=True):
+        """
+        Diagonalise a stack of dynamical matrices. Return freq,evec.
+        """
+        return EigenSolver(dyn,herm=self.__is_herm(dyn),evec=evec)
+
+    def get_ph_sparse(self,nev=20,sigma=None,window=None,evec=True):
+        """
+        Phonons of large supercells, e.g., quantum dots, from the sparse
+        ion+BC matrices with shift-invert ARPACK. The BCs are eliminated
+        inside the sparse factorisation, so no dense matrix is formed.
+        nev: int
+            number of modes closest to sigma
+        sigma: float
+            in THz, by default the lowest nev modes are computed
+        window: tuple (fmin,fmax)
+            all modes within the window in THz instead
+        return: list of frequencies at each k-point, see SparseEigenSolver
+        """
+        if self.fc == []:
+            raise ValueError("Force constants not set yet!")
+        elif self.kpts == []:
+            raise ValueError("Kpts not set yet!")
         if self.ecalc != None:
-            self.dyn += self.eps*self.ecalc.get_dyn(self.mass,self.kpts,crys=self.iskcrys,mode="abcm")
+            raise ValueError("Ewald interaction is dense, use get_ph_disp instead!")
+        self.dyn = DynBuild(self.bonds,self.bvec,self.kpts,self.N_ion,self.Mass,\
+                crys=self.iskcrys,sparse=True,gamma=not np.any(self.kpts))
+        self.freq,self.evec = SparseEigenSolver(self.dyn,nev=nev,sigma=sigma,\
+                window=window,nion=self.N_ion,evec=evec)
+        return self.freq
 
     def get_dyn(self):
         """
@@ -510,15 +659,79 @@ class ABCM(object):
         else:
             raise ValueError("No dynamical matrix!")
 
-    def get_ph_disp(self):
+    def get_ph_disp(self,evec=True):
         """
         get the phonon band structure of the system provided all
         force constans and kpts are specified. Return phonon frequencies.
+        evec: boolean
+            if False, eigenvectors are skipped and self.evec is None
         """
-        self.__set_dyn()
-        self.freq,self.evec = EigenSolver(self.dyn,fldata=None,herm=False)
+        if self.nproc != 1:
+            if self.fc == []:
+                raise ValueError("Force constants not set yet!")
+            elif self.kpts == []:
+                raise ValueError("Kpts not set yet!")
+            self.dyn = None
+            self.freq,self.evec = ParallelSolver(self,self.kpts,self.iskcrys,\
+                    nproc=self.nproc,chunk=self.kchunk,evec=evec)
+        else:
+            self.__set_dyn()
+            self.freq,self.evec = self.solve_dyn(self.dyn,evec=evec)
         return self.freq
 
+    def __is_herm(self,dyn):
+        """
+        The dynamical matrix is Hermitian as long as the FC tensors of both
+        ends of a bond agree, see fix_interface(). Otherwise, fall back to
+        the general solver which gives the same frequencies as M^-1.D
+        """
+        herm = IsHermitian(dyn)
+        if not herm:
+            print "Warning: the dynamical matrix is not Hermitian, eig is used instead of eigh."
+        return herm
+
+    def get_dyn_operator(self,kpt,crys=True,inner="minres",tol=1e-10):
+        """
+        The short range dynamical matrix at a single k-point as a
+        scipy.sparse.linalg.LinearOperator, e.g., for Lanczos methods.
+        The bonds are applied directly and the BCs are eliminated on the
+        fly, i.e., y = M^-1/2.(R.x - T.S^-1.Ts.x) with x scaled by M^-1/2.
+        kpt: array of 3
+        crys: boolean
+            True, for crystal coordinates [default]
+            False, in unit of 2pi/alat
+        inner: string
+            how S^-1 is applied: "minres", iterative and matrix-free (S is
+            Hermitian but indefinite), or "splu", a sparse LU of S
+        tol: float
+            tolerance of the inner MINRES
+        """
+        from scipy.sparse.linalg import LinearOperator,splu
+        if self.fc == []:
+            raise ValueError("Force constants not set yet!")
+        if self.ecalc != None:
+            raise ValueError("Ewald interaction is dense, use get_ph_disp instead!")
+        n = self.nbnd; nbc = 3*self.N_bc
+        K = BondOperator(self.bonds,self.bvec,kpt,crys=crys)
+        dtype = complex if np.any(kpt) else float
+        pad = lambda a,b: np.concatenate((a,b)).astype(np.result_type(a,b,dtype))
+        if inner == "splu":
+            S = DynBuildFull(self.bonds,self.bvec,kpt,crys=crys,sparse=True,\
+                    gamma=dtype==float)[0][n:,n:]
+            solve = splu(S.tocsc()).solve
+        elif inner == "minres":
+            Smv = lambda z: K(pad(np.zeros(n),z))[n:]
+            solve = lambda b: HermitianSolve(Smv,b,tol=tol)
+        else:
+            raise ValueError("Unknown inner solver: "+inner)
+        scale = 1./np.sqrt(np.diag(self.Mass))
+        def matvec(x):
+            u = K(pad(scale*np.ravel(x),np.zeros(nbc)))
+            y = u[:n]
+            if nbc > 0: y = y-K(pad(np.zeros(n),solve(u[n:])))[:n]
+            return y*scale*M_THZ
+        return LinearOperator((n,n),matvec=matvec,dtype=dtype)
+
     def get_nn_label(self):
         """
         Neatly print out all nearest neighbours for each base atom.
@@ -555,7 +768,7 @@ class ABCM(object):
 
         grid = MonkhorstPack(kgrid,withBoundary=True)
         self.set_kpts(grid,crys=True)
-        freq = np.sort(self.get_ph_disp())
+        freq = np.sort(self.get_ph_disp(evec=False))
 
         self.dos = tetra_dos(freq,kgrid,grid,self.N,nstep)
         np.savetxt("dos.txt", self.dos.T, delimiter="\t",fmt="%10.5f")
@@ -677,7 +890,7 @@ class ABCM(object):
         # do a phonon calculation on the mesh
         grid = MonkhorstPack(kgrid,koff)
         self.set_kpts(grid,crys=True)
-        self.get_ph_disp()
+        self.get_ph_disp(evec=False)
         ph_e = self.freq.flatten()
         mask = ph_e<0.01 # truncated at 0.01THz
         ph_e += mask.astype(int)*0.01
@@ -731,9 +944,9 @@ class ABCM(object):
         self.k_conv(towhat='cart')
         kpts = np.copy(self.kpts)
         self.set_kpts(kpts+dk,crys=False)
-        self.get_ph_disp(); freq1 = np.sort(self.freq)
+        self.get_ph_disp(evec=False); freq1 = np.sort(self.freq)
         self.set_kpts(kpts,crys=False)
-        self.get_ph_disp(); freq0 = np.sort(self.freq)
+        self.get_ph_disp(evec=False); freq0 = np.sort(self.freq)
         df = (freq1-freq0)
         return df/norm(dk)
 
@@ -809,24 +1022,49 @@ class ABCM(object):
         # add eps if needed
         if self.ecalc != None:
             x0 = np.hstack((x0,eps0))
-            self.m_ewald = self.ecalc.get_dyn(self.mass,kpts,crys=crys,mode="abcm")
+            self.m_ewald = self.ecalc.get_dyn(self.mass,kpts,crys=crys,\
+                    mode="full" if self.single_pass else "abcm")
         
         self.set_fc(fc_dict)
 
         self.set_kpts(kpts,crys=crys)
         self.src_freq = np.sort(src_freq)
         assert len(self.src_freq) == self.nkpt
+        self.__set_fit_basis()
         if self.ecalc != None:
             res = minimize(self.__fit_ewald,x0=x0,method=method,options={"maxiter":maxiter})
             # res = minimize(self.__fit_ewald,x0=x0,method=method,options={"maxiter":maxiter},
             # bounds=((0.01,100),(0.01,100),(0.01,100),(0.01,100),(0,10)))
         else:
             res = minimize(self.__fit_no_ewald,x0=x0,method=method)
+        # the FCs of the last step, as the steps only use the basis
+        self.set_fc(self.fc_dict)
+        self.fit_fc = self.fit_full = None
 
         self.__log_fit(res,filename="log_fit.txt")
         del minimize
 
-    def __fit_no_ewald(self,fc):
+    def __set_fit_basis(self):
+        # The FCs and the full ion+BC matrices are linear in the parameters,
+        # so each step of the fit is a weighted sum of those of the unit
+        # parameters, followed by the BC elimination. The full matrices at
+        # the fit k-points are kept if they fit in memory and the BCs are
+        # eliminated densely; otherwise DynBuild is called with the FCs.
+        keys,self.fit_fc = self.fc_basis(self.fc_dict)
+        self.fit_full = None
+        dense = self.bcsolver == "dense" or (self.bcsolver == None and \
+                (self.N_bc <= 64 or (self.ecalc != None and self.single_pass)))
+        if dense and ChunkSize(3*self.N) >= len(keys)*self.nkpt:
+            self.fit_full = np.zeros((len(keys),self.nkpt,3*self.N,3*self.N),dtype=complex)
+            fc = self.bonds.fc
+            for n,unit in enumerate(self.fit_fc):
+                self.bonds.fc = unit
+                self.fit_full[n] = DynBuildFull(self.bonds,self.bvec,self.kpts,crys=self.iskcrys)
+            self.bonds.fc = fc
+
+    def __fit_params(self,fc):
+        # set fc_dict from the parameters of a fit step and return them as
+        # the weights of the basis
         afc = np.abs(fc[:self.na]); bfc = np.abs(fc[self.na:self.na+self.nb]); sfc = fc[self.na+self.nb:]
         if self.alpha:
             for i in range(self.na):
@@ -840,32 +1078,37 @@ class ABCM(object):
             for i in range(self.ns):
                 self.fc_dict['sigma'][self.skeys[i]] = sfc[i]
             print "sigma: ", self.fc_dict['sigma']
-        self.set_fc(self.fc_dict)
-        freq = np.sort(self.get_ph_disp())
-        return ((freq-self.src_freq)**2).sum()/len(freq)
+        return np.concatenate((afc,bfc,sfc))
+
+    def __fit_dyn(self,w,coulomb=None):
+        # short range dynamical matrices at the fit k-points for the weights
+        # w of the basis, see DynBuild for coulomb
+        if self.fit_full is None:
+            self.fc = np.tensordot(w,self.fit_fc,1)
+            return DynBuild(self.bonds,self.bvec,self.kpts,self.N_ion,self.Mass,\
+                    crys=self.iskcrys,bcsolver=self.bcsolver,coulomb=coulomb)
+        dyn1 = np.tensordot(w,self.fit_full,1)
+        if coulomb != None: dyn1 += coulomb(0,self.nkpt)
+        M_12 = 1./np.sqrt(np.diag(self.Mass))
+        return M_12.reshape(-1,1)*BCEliminate(dyn1,self.N_ion)*M_12*M_THZ
+
+    def __fit_no_ewald(self,fc):
+        dyn = self.__fit_dyn(self.__fit_params(fc))
+        freq,evec = self.solve_dyn(dyn,evec=False)
+        self.freq = np.sort(freq)
+        return ((self.freq-self.src_freq)**2).sum()/len(freq)
 
     def __fit_ewald(self,x0):
         # x0 = abs(x0)
         fc = x0[:-1]; self.eps = abs(x0[-1])
-        afc = np.abs(fc[:self.na]); bfc = np.abs(fc[self.na:self.na+self.nb]); sfc = fc[self.na+self.nb:]
-        if self.alpha:
-            for i in range(self.na):
-                self.fc_dict['alpha'][self.akeys[i]] = afc[i]
-            print "alpha: ", self.fc_dict['alpha']
-        if self.beta:
-            for i in range(self.nb):
-                self.fc_dict['beta'][self.bkeys[i]] = bfc[i]
-            print "beta: ", self.fc_dict['beta']
-        if self.sigma:
-            for i in range(self.ns):
-                self.fc_dict['sigma'][self.skeys[i]] = sfc[i]
-            print "sigma: ", self.fc_dict['sigma']
+        w = self.__fit_params(fc)
         print "eps = %10.5f" % self.eps
-        self.set_fc(self.fc_dict)
-        dyn0 = DynBuild(self.bas,self.bvec,self.fc,\
-                self.nn,self.label,self.kpts,self.N_ion,self.Mass,crys=self.iskcrys)
-        dyn = self.eps*self.m_ewald + dyn0
-        freq,evec = EigenSolver(dyn,fldata=None,herm=False)
+        if self.single_pass:
+            coulomb = lambda start,stop: self.eps*self.m_ewald[start:stop]
+            dyn = self.__fit_dyn(w,coulomb)
+        else:
+            dyn = self.eps*self.m_ewald + self.__fit_dyn(w)
+        freq,evec = self.solve_dyn(dyn,evec=False)
         self.freq = np.sort(freq)
         return ((self.freq-self.src_freq)**2).sum()/len(freq)
 
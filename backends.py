@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+Registry of interchangeable implementations (backends) of the hot kernels,
+e.g., "assemble", "eliminate", "eigensolve", "dos" in commonfunc and
+"ewald" in ewald/ewald.py. Each module registers its own implementations,
+which take the same arguments and give the same results.
+
+The backend of a call is chosen by, in this order,
+1. the backend argument of the call, e.g., EigenSolver(...,backend="python")
+2. the environment variable LATDYN_BACKEND_<KERNEL>, e.g.,
+   LATDYN_BACKEND_EWALD=numpy
+3. the environment variable LATDYN_BACKEND
+4. PREFERENCE
+Each of them may be a comma separated list in order of preference. The
+first available one is used, e.g., "fortran" is not available when
+dyn_ewald is not compiled. The environment variables fall back to
+PREFERENCE, while an explicit backend argument does not.
+
+With LATDYN_BACKEND_CHECK set to a tolerance, e.g., 1e-8, (or set_check),
+every call also runs all other available backends and compares their
+results with the selected one; a ValueError is raised on mismatch.
+'''
+import os
+import numpy as np
+from collections import OrderedDict
+
+PREFERENCE = ("fortran","numpy","python")
+_registry = OrderedDict()
+_check = [None]
+
+def register(kernel,backend,func,compare=None):
+    """
+    Register func as the implementation of kernel by backend.
+    func: function or None
+        None marks the backend as not available, e.g., not compiled
+    compare: function
+        result -> ndarray compared in the check mode, by default the
+        result itself, or its first item if it is a tuple
+    """
+    _registry.setdefault(kernel,OrderedDict())[backend] = (func,compare)
+
+def available(kernel):
+    """
+    Available backends of kernel in order of preference.
+    """
+    impl = _registry.get(kernel,{})
+    order = [name for name in PREFERENCE if name in impl]
+    order += [name for name in impl if name not in PREFERENCE]
+    return [name for name in order if impl[name][0] != None]
+
+def _names(choice):
+    if choice == None: return []
+    if isinstance(choice,str): choice = choice.split(",")
+    return [name.strip() for name in choice if name.strip()]
+
+def select(kernel,backend=None):
+    """
+    Name of the backend used for kernel, see the module doc.
+    """
+    if kernel not in _registry:
+        raise ValueError("Unknown kernel: "+kernel)
+    avail = available(kernel)
+    if backend != None:
+        for name in _names(backend):
+            if name in avail: return name
+        raise ValueError("Backend %s is not available for %s, choose from %s" \
+                % (backend,kernel,avail))
+    for name in _names(os.environ.get("LATDYN_BACKEND_"+kernel.upper())) \
+            + _names(os.environ.get("LATDYN_BACKEND")) + avail:
+        if name in avail: return name
+    raise ValueError("No backend is available for "+kernel)
+
+def set_check(tol=1e-8):
+    """
+    Turn the consistency check on (relative tolerance tol) or off (None).
+    It overrides LATDYN_BACKEND_CHECK.
+    """
+    _check[0] = tol
+
+def get_check():
+    """
+    Relative tolerance of the consistency check, None if it is off.
+    """
+    if _check[0] != None: return _check[0]
+    tol = os.environ.get("LATDYN_BACKEND_CHECK")
+    if tol in (None,"","0"): return None
+    return 1e-8 if tol == "1" else float(tol)
+
+def _value(result,compare):
+    if compare != None: return np.asarray(compare(result))
+    if isinstance(result,tuple): result = result[0]
+    return np.asarray(result)
+
+def call(kernel,*args,**kwargs):
+    """
+    Run kernel(*args,**kwargs) with the selected backend, given by the
+    keyword backend (default None, see select).
+    """
+    name = select(kernel,kwargs.pop("backend",None))
+    func,compare = _registry[kernel][name]
+    result = func(*args,**kwargs)
+    tol = get_check()
+    if tol == None: return result
+    ref = _value(result,compare)
+    scale = max(np.abs(ref).max() if ref.size else 0.,1e-30)
+    for other in available(kernel):
+        if other == name: continue
+        func,compare = _registry[kernel][other]
+        err = np.abs(_value(func(*args,**kwargs),compare)-ref).max()/scale if ref.size else 0.
+        print "Check %s: %s vs %s, max relative difference %.2e" % (kernel,other,name,err)
+        if not err <= tol:
+            raise ValueError("Backends %s and %s of %s differ by %.2e!" % (other,name,kernel,err))
+    return result
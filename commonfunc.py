@@ -1,29 +1,502 @@
 #!/usr/bin/env python
 import numpy as np
-from numpy.linalg import inv,eigh,eig,norm
+from numpy.linalg import inv,eigh,eig,eigvalsh,eigvals,norm
 from constants import M_THZ,TPI,KB,THZ_TO_J
+from backends import register,call
 import pickle
 
-def EigenSolver(m,fldata="freq_mode_dyn.pckl",herm=True):
+def _eigen_numpy(m,herm,evec):
+    # batched LAPACK calls over the stack
+    if evec: return eigh(m) if herm else eig(m)
+    return (eigvalsh(m) if herm else eigvals(m)),None
+
+def _eigen_python(m,herm,evec):
+    # reference, one matrix at a time
+    w = []; v = []
+    for item in m:
+        tmp = _eigen_numpy(item[np.newaxis],herm,evec)
+        w.append(tmp[0][0])
+        if evec: v.append(tmp[1][0])
+    return np.array(w),(np.array(v) if evec else None)
+
+register("eigensolve","numpy",_eigen_numpy,compare=lambda res: np.sort(res[0].real,axis=-1))
+register("eigensolve","python",_eigen_python,compare=lambda res: np.sort(res[0].real,axis=-1))
+
+def EigenSolver(m,fldata=None,herm=True,evec=True,chunk=None,backend=None):
     """
     This function returns phonon frequencies in THz
     and dump the results if fldata != None
+    m: ndarray of shape (nks,nval,nval)
+        stack of dynamical matrices, diagonalised chunk by chunk with
+        batched LAPACK calls
+    herm: boolean
+        eigh/eigvalsh for Hermitian matrices, otherwise eig/eigvals
+    evec: boolean
+        if False, only eigenvalues are computed and None is returned
+        in place of the eigenvectors
+    chunk: int
+        number of matrices per LAPACK batch, by default about 256 MB
+    backend: str
+        "numpy" or "python", see backends
+    return: freq,evec
     """
     nks = len(m)
-    nval = len(m[0,0,:])
-    w2 = np.zeros((nks,nval),dtype=complex)
-    evec = np.zeros(m.shape,dtype=complex)
-    for q in range(nks):
-        tmp,evec[q] = eigh(m[q]) if herm else eig(m[q])
-        w2[q] = tmp.real
-        mask = (w2[q]<-1e-4); pm = mask*-1; pm[mask==False] = 1
-        if mask.sum() > 0:
-            print "Warning: imaginary frequency occurs at k[%d]" % q
+    nval = m.shape[-1]
+    if chunk == None: chunk = ChunkSize(nval)
+    w2 = np.zeros((nks,nval))
+    vec = None
+    for q in range(0,nks,chunk):
+        tmp,v = call("eigensolve",m[q:q+chunk],herm,evec,backend=backend)
+        if evec:
+            # eig may give real eigenvectors for one chunk and complex ones
+            # for the next, so they are kept complex unless herm
+            if vec is None: vec = np.zeros((nks,)+v.shape[1:],dtype=v.dtype if herm else complex)
+            vec[q:q+chunk] = v
+        w2[q:q+chunk] = tmp.real
     mask = (w2<-1e-4); pm = mask*-1; pm[mask==False] = 1
+    for q in np.nonzero(mask.any(axis=1))[0]:
+        print "Warning: imaginary frequency occurs at k[%d]" % q
     freq = np.sqrt(np.abs(w2))/TPI*pm
     if fldata:
-        pickle.dump((freq,evec,m),open(fldata,"wb"))
-    return freq,evec
+        pickle.dump((freq,vec,m),open(fldata,"wb"))
+    return freq,vec
+
+class BondTable(object):
+    """
+    Flat (CSR-like) table of the n.n. of all basis atoms, the canonical
+    storage of VFFM and ABCM. The bonds of atom i are offsets[i]:offsets[i+1]
+    and all per-bond arrays are contiguous, so that the per-bond work is
+    done in one go instead of looping over atoms.
+    basis: ndarray of shape (N,3)
+    lvec: ndarray of shape (3,3)
+    symbol: string array of shape (N,)
+    offsets: int array of shape (N+1,)
+    dst: int array of shape (nbonds,)
+        label of the neighbours in terms of no. of basis
+    nn: ndarray of shape (nbonds,3)
+        positions of the neighbours
+    Attributes:
+        src: int array, the atom each bond belongs to
+        image: int array of shape (nbonds,3), lattice translation of the
+            neighbour, i.e., nn = basis[dst]+image.lvec
+        x: bond vectors basis[src]-nn
+        dist: bond lengths
+        names, species: symbols and the integer code names.index(symbol)
+            of each neighbour, symb = names[species]
+        fc: ndarray of shape (nbonds,3,3) or None if not set
+    """
+    def __init__(self,basis,lvec,symbol,offsets,dst,nn):
+        basis = np.asarray(basis,dtype=float); symbol = np.asarray(symbol)
+        self.N = len(basis)
+        self.offsets = np.asarray(offsets,dtype=int)
+        self.src = np.repeat(np.arange(self.N),np.diff(self.offsets))
+        self.dst = np.asarray(dst,dtype=int)
+        self.nn = np.reshape(np.asarray(nn,dtype=float),(-1,3))
+        self.x = basis[self.src]-self.nn
+        self.dist = norm(self.x,axis=1)
+        self.image = np.rint((self.nn-basis[self.dst]).dot(inv(lvec))).astype(int)
+        self.names,codes = np.unique(symbol,return_inverse=True)
+        self.codes = codes # species code of each basis atom
+        self.species = codes[self.dst]
+        self.symb = self.names[self.species]
+        self.fc = None
+        self._lists = {}
+
+    @classmethod
+    def from_lists(cls,basis,lvec,symbol,nn,label):
+        """
+        Table from the ragged per-atom lists nn and label, see DynBuild.
+        """
+        offsets = np.concatenate(([0],np.cumsum([len(item) for item in label])))
+        dst = np.concatenate([np.asarray(item,dtype=int) for item in label])
+        nn = np.vstack([np.reshape(item,(-1,3)) for item in nn])
+        return cls(basis,lvec,symbol,offsets,dst,nn)
+
+    def __len__(self):
+        return len(self.dst)
+
+    def split(self,a):
+        """
+        Per-atom list of views of the per-bond array a.
+        """
+        return np.split(a,self.offsets[1:-1])
+
+    def per_atom(self,name):
+        """
+        split(self.name), cached until the attribute is replaced.
+        """
+        a = getattr(self,name)
+        if name not in self._lists or self._lists[name][0] is not a:
+            self._lists[name] = (a,self.split(a))
+        return self._lists[name][1]
+
+    def pairs(self):
+        """
+        All pairs (j,k), j != k, of bonds of the same atom, ordered by j
+        then k, e.g., for the bond-bending terms.
+        return: int arrays j,k
+        """
+        n = np.diff(self.offsets)[self.src]
+        j = np.repeat(np.arange(len(self)),n)
+        start = np.repeat(np.cumsum(n)-n,n)
+        k = self.offsets[self.src[j]]+np.arange(len(j))-start
+        keep = j != k
+        return j[keep],k[keep]
+
+    def reverse(self):
+        """
+        Index of the reverse bond, i.e., from dst to src with -image, of
+        each bond, -1 if the neighbour does not have it.
+        """
+        if len(self) == 0: return np.zeros(0,dtype=int)
+        m = np.abs(self.image).max(); w = 2*m+1
+        def key(a,b,image):
+            image = image+m
+            return ((a*self.N+b)*w+image[:,0])*w*w+image[:,1]*w+image[:,2]
+        fwd = key(self.src,self.dst,self.image)
+        order = np.argsort(fwd); fwd = fwd[order]
+        rev = key(self.dst,self.src,-self.image)
+        pos = np.minimum(np.searchsorted(fwd,rev),len(self)-1)
+        return np.where(fwd[pos] == rev,order[pos],-1)
+
+    def set_fc(self,fc):
+        """
+        fc: ndarray of shape (nbonds,3,3) or per-atom list of (n_i,3,3)
+        """
+        fc = np.concatenate([np.reshape(item,(-1,3,3)) for item in fc]) \
+                if isinstance(fc,list) else np.asarray(fc,dtype=float)
+        if fc.shape != (len(self),3,3):
+            raise ValueError("fc does not match the bonds!")
+        self.fc = np.ascontiguousarray(fc)
+
+def NeighbourSearch(basis,lvec,scope=[1,1,1],nmax=20):
+    """
+    The nmax-1 nearest neighbours of each basis atom among the periodic
+    images within scope, from a KD-tree query of all atoms at once instead
+    of sorting the distances to all images, i.e., O(N*log(N)) not O(N^2).
+    basis: ndarray of shape (N,3)
+    lvec: ndarray of shape (3,3)
+    scope: list or tuple of 3
+        images -scope..scope of the lattice vectors
+    return: tuple (dist,ind,allatoms,nimg)
+        dist,ind: ndarrays of shape (N,nmax-1), the distances in ascending
+            order and the indices of the neighbours in allatoms, the atom
+            itself excluded. Neighbours at the same distance are in the
+            order of allatoms.
+        allatoms: ndarray of shape (N*nimg,3), all images, basis atom by
+            basis atom, i.e., ind/nimg is the label of the neighbour
+    """
+    from scipy.spatial import cKDTree
+    X,Y,Z = scope
+    x,y,z = np.mgrid[-X:X+1, -Y:Y+1, -Z:Z+1]
+    xyz = np.asarray((x.reshape(-1),y.reshape(-1),z.reshape(-1))).T
+    rgrid = xyz.dot(lvec)
+    allatoms = (np.reshape(basis,(-1,1,3))+rgrid).reshape(-1,3)
+    k = min(nmax,len(allatoms))
+    dist,ind = cKDTree(allatoms).query(basis,k=k)
+    dist = np.reshape(dist,(len(basis),k)); ind = np.reshape(ind,(len(basis),k))
+    order = np.lexsort((ind,np.round(dist,10)),axis=-1)
+    dist = np.take_along_axis(dist,order,-1); ind = np.take_along_axis(ind,order,-1)
+    # the first one is the atom itself
+    return dist[:,1:],ind[:,1:],allatoms,len(rgrid)
+
+def ScatterBlocks(blocks,src,dst,N):
+    """
+    Sum 3x3 blocks into a stack of (3N,3N) matrices, i.e.,
+    out[q,3*src[b]:3*src[b]+3,3*dst[b]:3*dst[b]+3] += blocks[q,b]
+    blocks: ndarray of shape (nks,nbonds,3,3), real or complex
+    src,dst: int arrays of shape (nbonds,)
+        block row and column in terms of no. of basis
+    N: int
+        number of basis
+    return: ndarray of shape (nks,3N,3N)
+    """
+    nks = len(blocks); dim = 3*N; size = nks*dim*dim
+    rows,cols = BlockIndex(src,dst)
+    idx = (rows*dim+cols).reshape(1,-1)+(np.arange(nks)*dim*dim).reshape(-1,1)
+    idx = idx.reshape(-1); blocks = blocks.reshape(-1)
+    if np.iscomplexobj(blocks):
+        out = np.bincount(idx,blocks.real,size)+1j*np.bincount(idx,blocks.imag,size)
+    else:
+        out = np.bincount(idx,blocks,size)
+    return out.reshape(nks,dim,dim)
+
+def _assemble_numpy(onsite,offsite,src,dst,phase,N):
+    return ScatterBlocks(phase[:,:,np.newaxis,np.newaxis]*offsite,src,dst,N)\
+            +ScatterBlocks(onsite[np.newaxis],src,src,N)
+
+def _assemble_python(onsite,offsite,src,dst,phase,N):
+    # reference, one bond at a time
+    dyn = np.zeros((len(phase),3*N,3*N),dtype=phase.dtype)
+    for b in range(len(src)):
+        i = 3*src[b]; j = 3*dst[b]
+        dyn[:,i:i+3,i:i+3] += onsite[b]
+        dyn[:,i:i+3,j:j+3] += phase[:,b,np.newaxis,np.newaxis]*offsite[b]
+    return dyn
+
+register("assemble","numpy",_assemble_numpy)
+register("assemble","python",_assemble_python)
+
+def BondAssemble(onsite,offsite,src,dst,phase,N,backend=None):
+    """
+    Dense matrices of all k-points from the bond lists, i.e., onsite[b] is
+    added to the block (src[b],src[b]) and phase[:,b]*offsite[b] to the
+    block (src[b],dst[b]).
+    onsite,offsite: ndarray of shape (nbonds,3,3)
+    src,dst: int arrays of shape (nbonds,)
+    phase: ndarray of shape (nks,nbonds), see BondPhase
+    N: int
+        number of basis
+    backend: str
+        "numpy" or "python", see backends
+    return: ndarray of shape (nks,3N,3N)
+    """
+    return call("assemble",onsite,offsite,src,dst,phase,N,backend=backend)
+
+def BondPhase(kpts,x,gamma=False):
+    """
+    Phase factors exp(-ik.x) of all bonds at all k-points.
+    kpts: ndarray of shape (nks,3), Cartesian
+    x: ndarray of shape (nbonds,3), bond vectors
+    gamma: boolean
+        all kpts are Gamma, real ones are returned
+    return: ndarray of shape (nks,nbonds)
+    """
+    if gamma:
+        if np.any(kpts): raise ValueError("gamma=True but not all kpts are Gamma!")
+        return np.ones((len(kpts),len(x)))
+    return np.exp(-1j*np.dot(kpts,x.T))
+
+def BondOperator(bonds,bvec,kpt,crys=True):
+    """
+    Matrix-free product with the unscaled short range matrix at a single
+    k-point, i.e., -fc on the diagonal blocks and exp(-ik.x)*fc on the
+    bonds, applied directly from the bond table. Memory is O(nbonds).
+    bonds: BondTable with fc set
+    kpt: array of 3
+        if crys: coordinates of reciprocal lattice vectors
+        else: in terms of 2pi/alat
+    return: function x -> K.x for x of shape (3N,), real at Gamma
+    """
+    N = bonds.N; src = bonds.src; dst = bonds.dst; fcb = bonds.fc
+    kpt = np.dot(kpt,bvec)*2.*np.pi if crys else np.asarray(kpt)*2.*np.pi
+    # ON-diagonal blocks summed per atom, OFF-diagonal ones kept per bond
+    onsite = np.zeros((N,3,3))
+    np.add.at(onsite,src,-fcb)
+    offsite = BondPhase([kpt],bonds.x,gamma=not np.any(kpt))[0].reshape(-1,1,1)*fcb
+    def matvec(v):
+        v = np.reshape(v,(N,3))
+        y = np.einsum('bij,bj->bi',offsite,v[dst])
+        out = np.einsum('nij,nj->ni',onsite,v).astype(np.result_type(y,v))
+        for i in range(3):
+            out[:,i] += np.bincount(src,y[:,i].real,N)
+            if np.iscomplexobj(y): out[:,i] += 1j*np.bincount(src,y[:,i].imag,N)
+        return out.reshape(-1)
+    return matvec
+
+def HermitianSolve(matvec,b,tol=1e-10,maxiter=None):
+    """
+    Solve A.x = b for a Hermitian, possibly indefinite, A given by its
+    matvec with MINRES. The complex system is solved in its real symmetric
+    form [[Re A,-Im A],[Im A,Re A]].
+    """
+    from scipy.sparse.linalg import minres,LinearOperator
+    n = len(b)
+    if not np.iscomplexobj(b):
+        v,info = minres(LinearOperator((n,n),matvec=matvec,dtype=float),b,\
+                tol=tol,maxiter=maxiter)
+        if info != 0: print "Warning: MINRES does not converge (info = %d)" % info
+        return v
+    def mv(v):
+        z = matvec(v[:n]+1j*v[n:])
+        return np.concatenate((z.real,z.imag))
+    A = LinearOperator((2*n,2*n),matvec=mv,dtype=float)
+    v,info = minres(A,np.concatenate((b.real,b.imag)),tol=tol,maxiter=maxiter)
+    if info != 0: print "Warning: MINRES does not converge (info = %d)" % info
+    return v[:n]+1j*v[n:]
+
+def BlockIndex(src,dst):
+    """
+    Row and column indices of the elements of 3x3 blocks.
+    src,dst: int arrays of shape (nbonds,)
+        block row and column in terms of no. of basis
+    return: tuple (rows,cols), int arrays of shape (nbonds,3,3)
+    """
+    ax = np.arange(3)
+    rows = (3*np.asarray(src)).reshape(-1,1,1)+ax.reshape(1,3,1)
+    cols = (3*np.asarray(dst)).reshape(-1,1,1)+ax.reshape(1,1,3)
+    return np.broadcast_arrays(rows,cols)
+
+def SparseBlocks(blocks,src,dst,N):
+    """
+    Sparse counterpart of ScatterBlocks for a single k-point.
+    blocks: ndarray of shape (nbonds,3,3)
+    return: scipy.sparse.csr_matrix of shape (3N,3N), duplicates summed
+    """
+    from scipy.sparse import coo_matrix
+    rows,cols = BlockIndex(src,dst)
+    return coo_matrix((np.reshape(blocks,-1),(rows.reshape(-1),cols.reshape(-1))),\
+            shape=(3*N,3*N)).tocsr()
+
+def SparseEigenSolver(m,nev=20,sigma=None,window=None,nion=None,evec=True):
+    """
+    Shift-invert Lanczos (ARPACK) for sparse dynamical matrices. Only
+    the modes closest to sigma, or those within the window, are computed.
+    m: list of scipy.sparse matrices, one for each k-point
+    nev: int
+        number of modes; with window, the initial guess which is doubled
+        until the window is covered
+    sigma: float
+        shift in THz, negative for imaginary frequencies. By default
+        slightly below zero, i.e., the lowest nev modes.
+    window: tuple (fmin,fmax)
+        frequency window in THz, it overrides sigma
+    nion: int
+        if given, m are the full ion+BC matrices, ions first, and the BCs
+        are eliminated implicitly: the ion block of (K - s.B)^-1, with B
+        the identity on the ions only, equals (R - T.S^-1.Ts - s)^-1. Only
+        the sparse K - s.B is factorised.
+    return: freq,evec
+        lists over the k-points, freq[q] sorted in ascending order and
+        evec[q] of shape (3*nion,nev); evec is None if evec=False
+    """
+    from scipy.sparse import identity,diags
+    from scipy.sparse.linalg import eigsh,splu,LinearOperator
+    if window != None:
+        w2min,w2max = [np.sign(f)*(f*TPI)**2 for f in window]
+        shift = 0.5*(w2min+w2max)
+    else:
+        shift = -1. if sigma == None else np.sign(sigma)*(sigma*TPI)**2
+    freq = []; vec = [] if evec else None
+    for q in range(len(m)):
+        K = m[q].tocsc()
+        dim = K.shape[0] if nion == None else 3*nion
+        if nion == None:
+            B = identity(dim,dtype=K.dtype,format="csc")
+        else:
+            B = diags(np.arange(K.shape[0])<dim,dtype=K.dtype,format="csc")
+        lu = splu(K-shift*B)
+        def opinv(x,lu=lu,K=K,dim=dim):
+            y = np.zeros(K.shape[0],dtype=K.dtype)
+            y[:dim] = np.ravel(x)
+            return lu.solve(y)[:dim]
+        A = LinearOperator((dim,dim),matvec=SchurMatvec(K,dim),dtype=K.dtype)
+        OPinv = LinearOperator((dim,dim),matvec=opinv,dtype=K.dtype)
+        k = nev
+        while True:
+            k = min(k,dim-1)
+            res = eigsh(A,k=k,sigma=shift,OPinv=OPinv,return_eigenvectors=evec)
+            w2,v = res if evec else (res,None)
+            w2 = w2.real
+            # the window is covered once a mode beyond each edge is found
+            if window == None or k == dim-1 or \
+                    np.abs(w2-shift).max() >= 0.5*(w2max-w2min):
+                break
+            k *= 2
+        if window != None:
+            mask = (w2>=w2min)*(w2<=w2max)
+            w2 = w2[mask]
+            if evec: v = v[:,mask]
+        order = w2.argsort()
+        pm = np.where(w2[order]<-1e-4,-1,1)
+        if (pm<0).any():
+            print "Warning: imaginary frequency occurs at k[%d]" % q
+        freq.append(np.sqrt(np.abs(w2[order]))/TPI*pm)
+        if evec: vec.append(v[:,order])
+    return freq,vec
+
+def SchurMatvec(K,dim):
+    """
+    Matrix-vector product with the Schur complement R - T.S^-1.Ts of the
+    sparse matrix K = [[R,T],[Ts,S]] without forming it. S is factorised
+    on the first call.
+    dim: int
+        dimension of R
+    """
+    from scipy.sparse.linalg import splu
+    K = K.tocsr(); R = K[:dim,:dim]; T = K[:dim,dim:]; Ts = K[dim:,:dim]
+    lu = []
+    def matvec(x):
+        x = np.ravel(x); y = R.dot(x)
+        if K.shape[0] > dim:
+            if lu == []: lu.append(splu(K[dim:,dim:].tocsc()))
+            y -= T.dot(lu[0].solve(Ts.dot(x)))
+        return y
+    return matvec
+
+def _eliminate_numpy(dyn1,Ni):
+    n = Ni*3
+    R = dyn1[:,:n,:n]; S = dyn1[:,n:,n:]
+    T = dyn1[:,:n,n:]; Ts = dyn1[:,n:,:n]
+    if S.shape[-1] == 0: return R.copy()
+    return R - np.matmul(T,np.linalg.solve(S,Ts))
+
+def _eliminate_python(dyn1,Ni):
+    # reference, one k-point at a time
+    return np.array([_eliminate_numpy(m[np.newaxis],Ni)[0] for m in dyn1])\
+            .reshape((len(dyn1),3*Ni,3*Ni))
+
+register("eliminate","numpy",_eliminate_numpy)
+register("eliminate","python",_eliminate_python)
+
+def BCEliminate(dyn1,Ni,backend=None):
+    """
+    Eliminate the bond charges from stacked ion+BC matrices by the Schur
+    complement R - T.S^-1.Ts. S^-1.Ts is obtained from a batched LU
+    factorise-and-solve rather than an explicit inverse.
+    dyn1: ndarray of shape (nks,3N,3N)
+        ions first, followed by the BCs
+    Ni: int
+        number of ions
+    backend: str
+        "numpy" or "python", see backends
+    return: ndarray of shape (nks,3Ni,3Ni)
+    """
+    return call("eliminate",dyn1,Ni,backend=backend)
+
+def SparseBCEliminate(dyn1,Ni,chunk=None):
+    """
+    Sparse counterpart of BCEliminate for large supercells. S is factorised
+    with a sparse LU and T.S^-1.Ts is formed a block of columns at a time,
+    so only the dense ion matrix of each k-point is ever allocated.
+    dyn1: list of scipy.sparse matrices of shape (3N,3N)
+        ions first, followed by the BCs
+    Ni: int
+        number of ions
+    chunk: int
+        number of columns per solve, by default about 256 MB of workspace
+    return: ndarray of shape (nks,3Ni,3Ni)
+    """
+    from scipy.sparse.linalg import splu
+    n = Ni*3
+    dyn = np.zeros((len(dyn1),n,n),dtype=np.result_type(*[m.dtype for m in dyn1]))
+    for q in range(len(dyn1)):
+        K = dyn1[q].tocsc()
+        dyn[q] = K[:n,:n].toarray()
+        if K.shape[0] == n: continue
+        T = K[:n,n:].tocsr(); Ts = K[n:,:n]
+        lu = splu(K[n:,n:].tocsc())
+        step = chunk if chunk != None else max(1,int(2**28/(16*(K.shape[0]-n))))
+        for c in range(0,n,step):
+            dyn[q,:,c:c+step] -= T.dot(lu.solve(Ts[:,c:c+step].toarray()))
+    return dyn
+
+def IsHermitian(m,tol=1e-8):
+    """
+    Check whether all matrices in the stack m are Hermitian.
+    tol: float
+        tolerance relative to the largest element
+    """
+    m = np.asarray(m)
+    if m.size == 0: return True
+    scale = max(np.abs(m).max(),1e-30)
+    return bool(np.abs(m-np.conj(np.swapaxes(m,-1,-2))).max() <= tol*scale)
+
+def ChunkSize(dim,itemsize=16,budget=2**28):
+    """
+    Number of (dim,dim) matrices that fit in the memory budget (bytes).
+    """
+    return max(1,int(budget/(itemsize*dim*dim)))
 
 def MonkhorstPack(kgrid=(4,4,4),koff=(0,0,0),withBoundary=False):
     """
@@ -47,7 +520,46 @@ def MonkhorstPack(kgrid=(4,4,4),koff=(0,0,0),withBoundary=False):
     k_xyz = np.array((kx,ky,kz)).T
     return k_xyz
 
-def tetra_dos(freq,kgrid,grid,N,nstep):
+def _tetra_diff(f1,f2,f3,f4):
+    # get rid of dividing zeros
+    diff = [f2-f1,f3-f1,f4-f1,f3-f2,f4-f2,f4-f3]
+    return [d+(d<1e-3)*1e-4 for d in diff]
+
+def _dos_numpy(corners,fall):
+    # corners: sorted frequencies at the 4 corners, shape = 4,ntetra
+    f1,f2,f3,f4 = corners
+    f21,f31,f41,f32,f42,f43 = _tetra_diff(f1,f2,f3,f4)
+    dos = np.zeros(len(fall))
+    for i in range(len(fall)):
+        f = fall[i]
+        c2 = (f<f2)*(f>=f1) # in Appendix C, Blochl PRB 1994
+        c3 = (f<f3)*(f>=f2)
+        c4 = (f<=f4)*(f>=f3)
+        d2 = 3.*(f-f1)**2/f21/f31/f41 * c2
+        d3 = (3.*f21+6*(f-f2)-3.*(f31+f42)*(f-f2)**2/f32/f42) \
+                / f31/f41 * c3
+        d4 = 3.*(f4-f)**2/f41/f42/f43 * c4
+        dos[i] = (d2+d3+d4).sum()
+    return dos
+
+def _dos_python(corners,fall):
+    # reference, one tetrahedron at a time
+    dos = np.zeros(len(fall))
+    for f1,f2,f3,f4 in corners.T:
+        f21,f31,f41,f32,f42,f43 = _tetra_diff(f1,f2,f3,f4)
+        for i,f in enumerate(fall):
+            if f1 <= f < f2:
+                dos[i] += 3.*(f-f1)**2/f21/f31/f41
+            elif f2 <= f < f3:
+                dos[i] += (3.*f21+6*(f-f2)-3.*(f31+f42)*(f-f2)**2/f32/f42)/f31/f41
+            if f3 <= f <= f4:
+                dos[i] += 3.*(f4-f)**2/f41/f42/f43
+    return dos
+
+register("dos","numpy",_dos_numpy)
+register("dos","python",_dos_python)
+
+def tetra_dos(freq,kgrid,grid,N,nstep,backend=None):
     """
     Using the tetrahedron method to get DOS
     Ref:
@@ -62,10 +574,11 @@ def tetra_dos(freq,kgrid,grid,N,nstep):
         total points in DOS
     kgrid: tuple of 3 integers
         Gamma centred k grid
+    backend: str
+        "numpy" or "python", see backends
     """
 
     grid0 = MonkhorstPack(kgrid)
-    dos = np.zeros(nstep)
     fall = np.linspace(freq.min(),freq.max(),nstep)
     tetra = np.array([
             [0.,0.,0.],[0.,0.,1.],[0.,1.,0.],[1.,0.,1.], # 1,5,3,6
@@ -86,27 +599,8 @@ def tetra_dos(freq,kgrid,grid,N,nstep):
     freq6 = freq[indices] # shape = 24,len(grid0),len(freq[0])
     freq6 = freq6.reshape((6,4,len(grid0),-1))
     freq6 = np.sort(freq6,axis=1)
-    f1 = freq6[:,0,:,:]; f2 = freq6[:,1,:,:]
-    f3 = freq6[:,2,:,:]; f4 = freq6[:,3,:,:]
-    f21 = f2 - f1; f31 = f3 - f1; f41 = f4 - f1
-    f32 = f3 - f2; f42 = f4 - f2; f43 = f4 - f3
-    # get rid of dividing zeros
-    mask = (f21<1e-3); f21 += mask*1e-4
-    mask = (f31<1e-3); f31 += mask*1e-4
-    mask = (f41<1e-3); f41 += mask*1e-4
-    mask = (f32<1e-3); f32 += mask*1e-4
-    mask = (f42<1e-3); f42 += mask*1e-4
-    mask = (f43<1e-3); f43 += mask*1e-4
-    for i in range(nstep):
-        f = fall[i]
-        c2 = (f<f2)*(f>=f1) # in Appendix C, Blochl PRB 1994
-        c3 = (f<f3)*(f>=f2)
-        c4 = (f<=f4)*(f>=f3)
-        d2 = 3.*(f-f1)**2/f21/f31/f41 * c2
-        d3 = (3.*f21+6*(f-f2)-3.*(f31+f42)*(f-f2)**2/f32/f42) \
-                / f31/f41 * c3
-        d4 = 3.*(f4-f)**2/f41/f42/f43 * c4
-        dos[i] = (d2+d3+d4).sum()
+    corners = np.swapaxes(freq6,0,1).reshape(4,-1)
+    dos = call("dos",corners,fall,backend=backend)
 
     integral = np.trapz(y=dos,x=fall)
     dos *= N*3.0/integral
@@ -3,271 +3,397 @@
 ! It is written in Fortran and compiled so that speed is guaranteed.
 ! Hongze Xia, Sat Aug 23 18:19:39 2014
 ! f2py -llapack -lblas -c -m dyn_ewald dyn_ewald.pyf dyn_ewald.f90
+! with OpenMP threads:
+! f2py --f90flags=-fopenmp -lgomp -llapack -lblas -c -m dyn_ewald dyn_ewald.pyf dyn_ewald.f90
 ! Wed 22 Apr 2015 15:21:57 AEST: subroutine dyn_abcm is added to this file
+! abcm returns the Hermitian form M^-1/2.(R - T.S^-1.Ts).M^-1/2
+! full returns the ion+BC matrices before the elimination
+! All kernels share ewald_prep, where everything that does not depend on q,
+! i.e., the real space tensors, the structure factors and the onsite sums,
+! is computed once, and ewald_block, which fills the matrices of a block of
+! q-points from it. abcm goes through q a block at a time, so only the full
+! ion+BC matrices of one block are held before the elimination.
+! The assembly is threaded over the rows of atoms and the BC elimination over
+! the q-points of a block, each thread with its own LAPACK scratch;
+! nthreads <= 0 means the OpenMP default.
+! The real space sums run over a pair list in CSR form, see Ewald.get_pairs:
+! the images of n1 are n2 = indices(indptr(n1)+1:indptr(n1+1)) with R in
+! rmesh(images(...)), so only the pairs within the cutoff are visited.
 ! --------------------------------------------------------------------------------------------------
-    SUBROUTINE vffm(atoms,mass,charge,rmesh,kmesh,alpha,vol,qvec,dyn,N,nq,nr,nk)
+    SUBROUTINE ewald_prep(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,nt,pfc,sf,onsite,N,nr,npair,nk)
 
     IMPLICIT NONE
+    ! the part of ewald_full that does not depend on q
     ! ============constants========= !
     real(8), parameter :: pi = 3.1415927
     complex(8), parameter :: j = (0,1)
     ! ============input============= !
     ! atoms.shape=(N,3) so are the meshes
-    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
-    real(8), intent(in) :: mass(N),charge(N)
+    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3)
+    ! pair list, counted from 0
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
+    ! w: weight of each atom, 1/SQRT(mass) or 1
+    real(8), intent(in) :: w(N),charge(N)
     real(8), intent(in) :: alpha,vol
-    integer, intent(in) :: N,nr,nk,nq
+    ! nt: number of threads
+    integer, intent(in) :: N,nr,npair,nk,nt
     ! ============output============ !
-    complex(8),dimension(nq,3*N,3*N),intent(out) :: dyn
+    ! weighted real space tensor of each pair, zero for an atom and itself
+    real(8), intent(out) :: pfc(3,3,npair)
+    ! charge*EXP(j*k.r) of each atom
+    complex(8), intent(out) :: sf(nk,N)
+    ! onsite block of each atom
+    complex(8), intent(out) :: onsite(3,3,N)
     ! ============local============= !
     ! force constant tensor
     real(8), dimension(3,3) :: fc,fc1
+    ! onsite prefactors of k
+    real(8) :: kfac(nk)
     ! temporary variables
-    real(8) :: r(3),r2,kr,k_q2,k2,k_q(3),k_qr,qr,q1,q2,expa2r2,masssqrt
-    integer :: n0,n1,n2,a,b,nrr,nkk
+    real(8) :: r(3),r2,k2,expa2r2
+    complex(8) :: rho(nk)
+    integer :: n1,n2,a,b,np0,nkk
 
-    dyn = 0.0
-    !    
-    DO n0 = 1,nq
-        !
-        DO n1 = 1,N
-            !
-            q1 = charge(n1)
-            DO n2 = 1,N
+    ! nt goes to NUM_THREADS, which needs it positive; this is also the only
+    ! use of nt in serial builds
+    IF (nt .LT. 1) STOP "error:the number of threads should be positive"
+    ! reciprocal space: q1*q2*EXP(j*k.(r1-r2)) = sf(k,n1)*CONJG(sf(k,n2))
+    DO n1 = 1,N
+        DO nkk = 1,nk
+            sf(nkk,n1) = charge(n1)*EXP(j*DOT_PRODUCT(kmesh(nkk,:),atoms(n1,:)))
+        END DO
+    END DO
+    rho = SUM(sf,DIM=2)
+    DO nkk = 1,nk
+        k2 = DOT_PRODUCT(kmesh(nkk,:),kmesh(nkk,:))
+        kfac(nkk) = 0.0
+        IF (k2 .GT. 1.0D-6) kfac(nkk) = 4.*pi/k2*EXP(-k2/4./alpha**2)/vol
+    END DO
+    !
+    ! each thread does the pairs and the onsite block of its own atoms n1
+    !$OMP PARALLEL DO NUM_THREADS(nt) SCHEDULE(DYNAMIC) &
+    !$OMP PRIVATE(n2,a,b,np0,nkk,r,r2,expa2r2,fc,fc1)
+    DO n1 = 1,N
+        onsite(:,:,n1) = 0.0
+        ! real space: the tensors do not depend on q, only the phases do
+        DO np0 = indptr(n1)+1,indptr(n1+1)
+            n2 = indices(np0)+1
+            pfc(:,:,np0) = 0.0
+            r = atoms(n1,:)-atoms(n2,:)+rmesh(images(np0)+1,:)
+            r2 = DOT_PRODUCT(r,r)
+            IF (r2 .LT. 1.0D-4) CYCLE
+            ! Mind the Negative sign
+            expa2r2 = EXP(-r2*alpha*alpha)
+            fc = 0.0
+            DO a = 1,3
+                DO b = 1,3
                 !
-                q2 = charge(n2)
-                masssqrt = 1.0/SQRT(mass(n1)*mass(n2))
-                ! real space
-                DO nrr = 1,nr
-                    !
-                    r = atoms(n1,:)-atoms(n2,:)+rmesh(nrr,:)
-                    qr = DOT_PRODUCT(r,qvec(n0,:))
-                    r2 = DOT_PRODUCT(r,r)
-                    IF (r2 .LT. 1.0D-4) CYCLE
-                    ! Mind the Negative sign
-                    expa2r2 = EXP(-r2*alpha*alpha)
-                    fc = 0.0
-                    DO a = 1,3
-                        DO b = 1,3
-                        !
-                            IF (a .EQ. b) THEN
-                                fc(a,a) = -2*(r(a)**2)*alpha*expa2r2/SQRT(pi)/r2 &
-                                        *(2*(alpha**2) + 3/r2)
-                                fc(a,a) = fc(a,a) + 2.0*alpha*expa2r2/SQRT(pi)/r2 &
-                                        + ERFC(alpha*SQRT(r2))/r2**1.5*(1.0-3.0* &
-                                        r(a)**2/r2) 
-                            ELSE
-                                fc(a,b) = 4.0*SQRT(pi)*(alpha**3)*(r2**1.5) + &
-                                        6.0*SQRT(pi)*alpha*SQRT(r2) + 3.0*pi/ &
-                                        expa2r2*ERFC(alpha*SQRT(r2))
-                                fc(a,b) = -fc(a,b)*r(a)*r(b)*expa2r2/(pi*r2**2.5)
-                            END IF
-                        END DO
+                    IF (a .EQ. b) THEN
+                        fc(a,a) = -2*(r(a)**2)*alpha*expa2r2/SQRT(pi)/r2 &
+                                *(2*(alpha**2) + 3/r2)
+                        fc(a,a) = fc(a,a) + 2.0*alpha*expa2r2/SQRT(pi)/r2 &
+                                + ERFC(alpha*SQRT(r2))/r2**1.5*(1.0-3.0* &
+                                r(a)**2/r2)
+                    ELSE
+                        ! expa2r2 is kept out of the denominator, it
+                        ! underflows on large meshes
+                        fc(a,b) = (4.0*SQRT(pi)*(alpha**3)*(r2**1.5) + &
+                                6.0*SQRT(pi)*alpha*SQRT(r2))*expa2r2 + &
+                                3.0*pi*ERFC(alpha*SQRT(r2))
+                        fc(a,b) = -fc(a,b)*r(a)*r(b)/(pi*r2**2.5)
+                    END IF
+                END DO
+            END DO
+            !
+            fc = fc*charge(n1)*charge(n2)/2.0
+            onsite(:,:,n1) = onsite(:,:,n1) - fc*w(n1)*w(n1)
+            pfc(:,:,np0) = fc*w(n1)*w(n2)
+        END DO
+        ! reciprocal space
+        DO nkk = 1,nk
+            IF (kfac(nkk) .NE. 0.0) THEN
+                DO a = 1,3
+                    DO b = 1,3
+                        fc1(a,b) = kmesh(nkk,a)*kmesh(nkk,b)*kfac(nkk)
                     END DO
-                    !
-                    fc = fc*q1*q2/2.0
-                    dyn(n0,3*n1-2:3*n1,3*n1-2:3*n1) = dyn(n0,3*n1-2:3*n1,3*n1-2:3*n1) - fc/mass(n1)
-                    dyn(n0,3*n1-2:3*n1,3*n2-2:3*n2) = dyn(n0,3*n1-2:3*n1,3*n2-2:3*n2) + fc*EXP(-j*qr)*masssqrt
                 END DO
-                ! END real space
-                !
-                ! for reciprocal and dipole
-                r = atoms(n1,:)-atoms(n2,:)
-                !
-    !             IF (n1 .EQ. n2) CYCLE
-                ! reciprocal space
-                DO nkk = 1,nk
-                    !
-                    kr = DOT_PRODUCT(kmesh(nkk,:),r)
-                    k_q = kmesh(nkk,:)+qvec(n0,:)
-                    ! examine the qvec so that it is not too small
-                    IF (SQRT(DOT_PRODUCT(k_q,k_q)) .LT. 1.0D-10) THEN
-                        IF (nq-n0 .gt. 0) THEN
-                            k_q = k_q+1.0D-6*(qvec(n0+1,:)-k_q)
-                        ELSE IF (n0 .eq. nq .and. nq .ne. 1) THEN
-                            k_q = k_q+1.0D-6*(qvec(nq-1,:)-k_q)
-                        ELSE IF (nq .eq. 1) THEN
-                            k_q = k_q+1.0D-6
-                        END IF
-                    END IF
-                    k2 = DOT_PRODUCT(kmesh(nkk,:),kmesh(nkk,:))
-                    k_q2 = DOT_PRODUCT(k_q,k_q)
-                    k_qr = DOT_PRODUCT(k_q,r)
+                onsite(:,:,n1) = onsite(:,:,n1) - fc1*w(n1)*w(n1)*sf(nkk,n1)*CONJG(rho(nkk))
+            END IF
+        END DO
+    END DO
+    !$OMP END PARALLEL DO
+
+    END SUBROUTINE ewald_prep
+
+    SUBROUTINE ewald_block(atoms,w,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,q0,nt,pfc,sf,onsite,dyn,N,nq,nb,nr,npair,nk)
+
+    IMPLICIT NONE
+    ! the matrices of the q-points q0+1:q0+nb from the output of ewald_prep
+    ! ============constants========= !
+    real(8), parameter :: pi = 3.1415927
+    complex(8), parameter :: j = (0,1)
+    ! ============input============= !
+    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
+    real(8), intent(in) :: w(N),alpha,vol
+    integer, intent(in) :: N,nr,npair,nk,nq,nb,q0,nt
+    real(8), intent(in) :: pfc(3,3,npair)
+    complex(8), intent(in) :: sf(nk,N),onsite(3,3,N)
+    ! ============output============ !
+    complex(8),dimension(nb,3*N,3*N),intent(out) :: dyn
+    ! ============local============= !
+    ! tensors of k+q for the q-points of the block and all k
+    real(8), allocatable, dimension(:,:,:,:) :: fcq
+    ! temporary variables
+    real(8) :: r(3),k_q2,k_q(3)
+    complex(8) :: ph(nb),p
+    integer :: n0,n1,n2,a,b,np0,nkk,i1,i2
+
+    ! nt goes to NUM_THREADS, which needs it positive; this is also the only
+    ! use of nt in serial builds
+    IF (nt .LT. 1) STOP "error:the number of threads should be positive"
+    ALLOCATE(fcq(nb,3,3,nk))
+    !$OMP PARALLEL DO NUM_THREADS(nt) PRIVATE(n0,a,b,k_q,k_q2)
+    DO nkk = 1,nk
+        ! the k+q tensors, once for each q instead of each pair of atoms
+        DO n0 = q0+1,q0+nb
+            k_q = kmesh(nkk,:)+qvec(n0,:)
+            ! examine the qvec so that it is not too small
+            IF (SQRT(DOT_PRODUCT(k_q,k_q)) .LT. 1.0D-10) THEN
+                IF (nq-n0 .gt. 0) THEN
+                    k_q = k_q+1.0D-6*(qvec(n0+1,:)-k_q)
+                ELSE IF (n0 .eq. nq .and. nq .ne. 1) THEN
+                    k_q = k_q+1.0D-6*(qvec(nq-1,:)-k_q)
+                ELSE IF (nq .eq. 1) THEN
+                    k_q = k_q+1.0D-6
+                END IF
+            END IF
+            k_q2 = DOT_PRODUCT(k_q,k_q)
+            DO a = 1,3
+                DO b = 1,3
+                    fcq(n0-q0,a,b,nkk) = k_q(a)*k_q(b)*4.*pi/k_q2*EXP(-k_q2/4./alpha**2)/vol
+                END DO
+            END DO
+        END DO
+    END DO
+    !$OMP END PARALLEL DO
+    !
+    ! each thread fills the rows of its own atoms n1, so there is no race
+    !$OMP PARALLEL DO NUM_THREADS(nt) SCHEDULE(DYNAMIC) &
+    !$OMP PRIVATE(n0,n2,a,b,np0,nkk,i1,i2,r,ph,p)
+    DO n1 = 1,N
+        i1 = 3*n1-3
+        dyn(:,i1+1:i1+3,:) = 0.0
+        ! real space
+        DO np0 = indptr(n1)+1,indptr(n1+1)
+            n2 = indices(np0)+1
+            i2 = 3*n2-3
+            r = atoms(n1,:)-atoms(n2,:)+rmesh(images(np0)+1,:)
+            IF (DOT_PRODUCT(r,r) .LT. 1.0D-4) CYCLE
+            DO n0 = 1,nb
+                ph(n0) = EXP(-j*DOT_PRODUCT(r,qvec(q0+n0,:)))
+            END DO
+            DO b = 1,3
+                DO a = 1,3
+                    dyn(:,i1+a,i2+b) = dyn(:,i1+a,i2+b) + pfc(a,b,np0)*ph
+                END DO
+            END DO
+        END DO
+        ! END real space
+        !
+        ! reciprocal space
+        DO nkk = 1,nk
+            DO n2 = 1,N
+                i2 = 3*n2-3
+                p = sf(nkk,n1)*CONJG(sf(nkk,n2))*w(n1)*w(n2)
+                DO b = 1,3
                     DO a = 1,3
-                        DO b = 1,3
-                            fc(a,b) = k_q(a)*k_q(b)
-                            fc1(a,b) = kmesh(nkk,a)*kmesh(nkk,b)
-                        END DO
+                        dyn(:,i1+a,i2+b) = dyn(:,i1+a,i2+b) + fcq(:,a,b,nkk)*p
                     END DO
-                    !
-                    fc = fc*q1*q2*4.*pi/k_q2*EXP(-k_q2/4./alpha**2)/vol
-                    dyn(n0,3*n1-2:3*n1,3*n2-2:3*n2) = dyn(n0,3*n1-2:3*n1,3*n2-2:3*n2) + fc*EXP(j*kr)*masssqrt
-                    IF (k2 .GT. 1.0D-6) THEN
-                        fc1 = fc1*q1*q2*4.*pi/k2*EXP(-k2/4./alpha**2)/vol
-                        dyn(n0,3*n1-2:3*n1,3*n1-2:3*n1) = dyn(n0,3*n1-2:3*n1,3*n1-2:3*n1) - fc1/mass(n1)*EXP(j*kr)
-                    END IF
                 END DO
-                ! END reciprocal space
-                !
             END DO
-        !
         END DO
+        ! END reciprocal space
         !
+        DO b = 1,3
+            DO a = 1,3
+                dyn(:,i1+a,i1+b) = dyn(:,i1+a,i1+b) + onsite(a,b,n1)
+            END DO
+        END DO
     END DO
+    !$OMP END PARALLEL DO
+    DEALLOCATE(fcq)
+
+    END SUBROUTINE ewald_block
+
+    SUBROUTINE ewald_full(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nt,dyn,N,nq,nr,npair,nk)
+
+    IMPLICIT NONE
+    ! the matrices of all q-points at once
+    ! ============input============= !
+    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
+    real(8), intent(in) :: w(N),charge(N)
+    real(8), intent(in) :: alpha,vol
+    integer, intent(in) :: N,nr,npair,nk,nq,nt
+    ! ============output============ !
+    complex(8),dimension(nq,3*N,3*N),intent(out) :: dyn
+    ! ============local============= !
+    real(8), allocatable :: pfc(:,:,:)
+    complex(8), allocatable :: sf(:,:),onsite(:,:,:)
+
+    ALLOCATE(pfc(3,3,npair),sf(nk,N),onsite(3,3,N))
+    CALL ewald_prep(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,nt,pfc,sf,onsite,N,nr,npair,nk)
+    CALL ewald_block(atoms,w,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,0,nt,pfc,sf,onsite,dyn,N,nq,nq,nr,npair,nk)
+    DEALLOCATE(pfc,sf,onsite)
+
+    END SUBROUTINE ewald_full
+
+    SUBROUTINE vffm(atoms,mass,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nthreads,dyn,N,nq,nr,npair,nk)
+
+    !$ USE omp_lib
+    IMPLICIT NONE
+    ! ============input============= !
+    ! atoms.shape=(N,3) so are the meshes
+    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
+    real(8), intent(in) :: mass(N),charge(N)
+    real(8), intent(in) :: alpha,vol
+    integer, intent(in) :: N,nr,npair,nk,nq,nthreads
+    ! ============output============ !
+    complex(8),dimension(nq,3*N,3*N),intent(out) :: dyn
+    ! ============local============= !
+    real(8) :: w(N)
+    integer :: nt
+
+    nt = 1
+    !$ nt = omp_get_max_threads()
+    IF (nthreads .GT. 0) nt = nthreads
+    w = 1.0/SQRT(mass)
+    CALL ewald_full(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nt,dyn,N,nq,nr,npair,nk)
 
     END SUBROUTINE vffm
 
-    SUBROUTINE abcm(atoms,mass,charge,rmesh,kmesh,alpha,vol,qvec,dyn_abcm,N,NION,nq,nr,nk)
+    SUBROUTINE full(atoms,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nthreads,dyn,N,nq,nr,npair,nk)
 
+    !$ USE omp_lib
     IMPLICIT NONE
-    ! ============constants========= !
-    real(8), parameter :: pi = 3.1415927
-    complex(8), parameter :: j = (0,1)
+    ! full ion+BC matrices with unit weights, i.e., before the BCs are
+    ! eliminated, for the single pass abcm
     ! ============input============= !
     ! atoms.shape=(N,3) so are the meshes
     real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
+    real(8), intent(in) :: charge(N)
+    real(8), intent(in) :: alpha,vol
+    integer, intent(in) :: N,nr,npair,nk,nq,nthreads
+    ! ============output============ !
+    complex(8),dimension(nq,3*N,3*N),intent(out) :: dyn
+    ! ============local============= !
+    real(8) :: w(N)
+    integer :: nt
+
+    nt = 1
+    !$ nt = omp_get_max_threads()
+    IF (nthreads .GT. 0) nt = nthreads
+    w = 1.0
+    CALL ewald_full(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nt,dyn,N,nq,nr,npair,nk)
+
+    END SUBROUTINE full
+
+    SUBROUTINE abcm(atoms,mass,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,nthreads,dyn_abcm,N,NION,nq,nr,npair,nk)
+
+    !$ USE omp_lib
+    IMPLICIT NONE
+    ! ============input============= !
+    ! atoms.shape=(N,3) so are the meshes
+    real(8), intent(in) :: atoms(N,3),rmesh(nr,3),kmesh(nk,3),qvec(nq,3)
+    integer, intent(in) :: indptr(N+1),indices(npair),images(npair)
     ! mass.shape=(N,) so is charge, qvec.shape=(3,)
     real(8), intent(in) :: mass(NION),charge(N)
     real(8), intent(in) :: alpha,vol
-    integer, intent(in) :: N,NION,nr,nk,nq
+    integer, intent(in) :: N,NION,nr,npair,nk,nq,nthreads
     ! ============output============ !
     complex(8),dimension(nq,3*NION,3*NION),intent(out) :: dyn_abcm
     ! ============local============= !
-    ! force constant tensor
-    real(8), dimension(3,3) :: fc,fc1
-    ! temporary variables
-    real(8) :: r(3),r2,kr,k_q2,k2,k_q(3),k_qr,qr,q1,q2,expa2r2
-    integer :: n0,n1,n2,a,b,nrr,nkk
-    ! mass matrix inverted
-    real(8),dimension(3*NION,3*NION) :: mmat
-    !temporary dyn
-    complex(8),dimension(3*N,3*N) :: dyn
+    integer :: n0,n1,nt,q0,nb,nbq
+    ! M^-1/2 of the mass matrix
+    real(8),dimension(3*NION) :: msqrt
+    ! unit weights, the masses are applied after the elimination
+    real(8),dimension(N) :: w
+    ! q-independent data from ewald_prep
+    real(8), allocatable :: pfc(:,:,:)
+    complex(8), allocatable :: sf(:,:),onsite(:,:,:)
+    ! full ion+BC matrices of a block of q-points
+    complex(8),allocatable,dimension(:,:,:) :: full
     !
-    ! matrix inversion
+    ! matrix inversion, private to each thread
     complex*16,allocatable,dimension(:,:)::S
     complex*16,allocatable,dimension(:)::WORK
     integer,allocatable,dimension(:)::IPIV
     integer info,error,M
     !
-    mmat = 0.0
+    nt = 1
+    !$ nt = omp_get_max_threads()
+    IF (nthreads .GT. 0) nt = nthreads
     DO n1 = 1,NION
-        mmat(n1*3-2,n1*3-2) = 1./mass(n1)
-        mmat(n1*3-1,n1*3-1) = 1./mass(n1)
-        mmat(n1*3,n1*3) = 1./mass(n1)
+        msqrt(n1*3-2:n1*3) = 1./SQRT(mass(n1))
     END DO
     !
-    DO n0 = 1,nq
-        !
-        dyn = 0.0
-        !
-        DO n1 = 1,N
-            !
-            q1 = charge(n1)
-            DO n2 = 1,N
-                !
-                q2 = charge(n2)
-    !             masssqrt = 1.0/SQRT(mass(n1)*mass(n2))
-                ! real space
-                DO nrr = 1,nr
-                    !
-                    r = atoms(n1,:)-atoms(n2,:)+rmesh(nrr,:)
-                    qr = DOT_PRODUCT(r,qvec(n0,:))
-                    r2 = DOT_PRODUCT(r,r)
-                    IF (r2 .LT. 1.0D-4) CYCLE
-                    ! Mind the Negative sign
-                    expa2r2 = EXP(-r2*alpha*alpha)
-                    fc = 0.0
-                    DO a = 1,3
-                        DO b = 1,3
-                        !
-                            IF (a .EQ. b) THEN
-                                fc(a,a) = -2*(r(a)**2)*alpha*expa2r2/SQRT(pi)/r2 &
-                                        *(2*(alpha**2) + 3/r2)
-                                fc(a,a) = fc(a,a) + 2.0*alpha*expa2r2/SQRT(pi)/r2 &
-                                        + ERFC(alpha*SQRT(r2))/r2**1.5*(1.0-3.0* &
-                                        r(a)**2/r2) 
-                            ELSE
-                                fc(a,b) = 4.0*SQRT(pi)*(alpha**3)*(r2**1.5) + &
-                                        6.0*SQRT(pi)*alpha*SQRT(r2) + 3.0*pi/ &
-                                        expa2r2*ERFC(alpha*SQRT(r2))
-                                fc(a,b) = -fc(a,b)*r(a)*r(b)*expa2r2/(pi*r2**2.5)
-                            END IF
-                        END DO
-                    END DO
-                    !
-                    fc = fc*q1*q2/2.0
-                    dyn(3*n1-2:3*n1,3*n1-2:3*n1) = dyn(3*n1-2:3*n1,3*n1-2:3*n1) - fc
-                    dyn(3*n1-2:3*n1,3*n2-2:3*n2) = dyn(3*n1-2:3*n1,3*n2-2:3*n2) + fc*EXP(-j*qr)
-                END DO
-                ! END real space
-                !
-                ! for reciprocal and dipole
-                r = atoms(n1,:)-atoms(n2,:)
-                !
-    !             IF (n1 .EQ. n2) CYCLE
-                ! reciprocal space
-                DO nkk = 1,nk
-                    !
-                    kr = DOT_PRODUCT(kmesh(nkk,:),r)
-                    k_q = kmesh(nkk,:)+qvec(n0,:)
-                    ! examine the qvec so that it is not too small
-                    IF (SQRT(DOT_PRODUCT(k_q,k_q)) .LT. 1.0D-10) THEN
-                        IF (nq-n0 .gt. 0) THEN
-                            k_q = k_q+1.0D-6*(qvec(n0+1,:)-k_q)
-                        ELSE IF (n0 .eq. nq .and. nq .ne. 1) THEN
-                            k_q = k_q+1.0D-6*(qvec(nq-1,:)-k_q)
-                        ELSE IF (nq .eq. 1) THEN
-                            k_q = k_q+1.0D-6
-                        END IF
-                    END IF
-                    k2 = DOT_PRODUCT(kmesh(nkk,:),kmesh(nkk,:))
-                    k_q2 = DOT_PRODUCT(k_q,k_q)
-                    k_qr = DOT_PRODUCT(k_q,r)
-                    DO a = 1,3
-                        DO b = 1,3
-                            fc(a,b) = k_q(a)*k_q(b)
-                            fc1(a,b) = kmesh(nkk,a)*kmesh(nkk,b)
-                        END DO
-                    END DO
-                    !
-                    fc = fc*q1*q2*4.*pi/k_q2*EXP(-k_q2/4./alpha**2)/vol
-                    dyn(3*n1-2:3*n1,3*n2-2:3*n2) = dyn(3*n1-2:3*n1,3*n2-2:3*n2) + fc*EXP(j*kr)
-                    IF (k2 .GT. 1.0D-6) THEN
-                        fc1 = fc1*q1*q2*4.*pi/k2*EXP(-k2/4./alpha**2)/vol
-                        dyn(3*n1-2:3*n1,3*n1-2:3*n1) = dyn(3*n1-2:3*n1,3*n1-2:3*n1) - fc1*EXP(j*kr)
-                    END IF
-                END DO
-                ! END reciprocal space
-                !
-            END DO
+    w = 1.0
+    ALLOCATE(pfc(3,3,npair),sf(nk,N),onsite(3,3,N))
+    CALL ewald_prep(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,nt,pfc,sf,onsite,N,nr,npair,nk)
+    ! the full matrices are built and eliminated a block of q-points at a
+    ! time, about 128 MB per block but at least one q-point per thread
+    nb = MIN(nq,MAX(INT(2.0D0**27/(16.0D0*9*N*N)),nt,1))
+    M = (N-NION)*3
+    DO q0 = 0,nq-1,nb
+        nbq = MIN(nb,nq-q0)
+        ALLOCATE(full(nbq,3*N,3*N),stat=error)
+        IF (error.ne.0)THEN
+          PRINT *,"error:not enough memory"
+          STOP
+        END IF
+        CALL ewald_block(atoms,w,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,q0,nt,pfc,sf,onsite,full,&
+                N,nq,nbq,nr,npair,nk)
         !
-        END DO
-        ! matrix operations with LAPACK
-        M = (N-NION)*3
+        ! the scratch of each thread is allocated once for all its q-points
+        !$OMP PARALLEL NUM_THREADS(nt) PRIVATE(n0,n1,S,WORK,IPIV,info,error)
         ALLOCATE(S(M,M),WORK(M),IPIV(M),stat=error)
         IF (error.ne.0)THEN
           PRINT *,"error:not enough memory"
           STOP
         END IF
-        ! define S as the BC-BC matrix
-        S(:,:) = dyn(3*NION+1:3*N,3*NION+1:3*N)
-        ! LU factorisation
-        CALL ZGETRF(M,M,S,M,IPIV,info)
-        IF(info .ne. 0) THEN
-         WRITE(*,*) "LU factorisation failed"
-        END IF
-        ! Invert it
-        CALL ZGETRI(M,S,M,IPIV,WORK,M,info)
-        ! ABCM operation
-        dyn_abcm(n0,:,:) = dyn(1:3*NION,1:3*NION) - MATMUL( dyn(1:3*NION,3*NION+1:3*N),MATMUL( S,dyn(3*NION+1:3*N,1:3*NION) ) )
-        !
-        dyn_abcm(n0,:,:) = MATMUL(mmat,dyn_abcm(n0,:,:))
-        !
+        !$OMP DO SCHEDULE(DYNAMIC)
+        DO n0 = 1,nbq
+            ! matrix operations with LAPACK
+            ! define S as the BC-BC matrix
+            S(:,:) = full(n0,3*NION+1:3*N,3*NION+1:3*N)
+            ! LU factorisation
+            CALL ZGETRF(M,M,S,M,IPIV,info)
+            IF(info .ne. 0) THEN
+             WRITE(*,*) "LU factorisation failed"
+            END IF
+            ! Invert it
+            CALL ZGETRI(M,S,M,IPIV,WORK,M,info)
+            ! ABCM operation
+            dyn_abcm(q0+n0,:,:) = full(n0,1:3*NION,1:3*NION) - &
+                    MATMUL( full(n0,1:3*NION,3*NION+1:3*N),MATMUL( S,full(n0,3*NION+1:3*N,1:3*NION) ) )
+            !
+            ! M^-1/2 on both sides keeps the matrix Hermitian
+            DO n1 = 1,3*NION
+                dyn_abcm(q0+n0,n1,:) = dyn_abcm(q0+n0,n1,:)*msqrt(n1)*msqrt
+            END DO
+        END DO
+        !$OMP END DO
         DEALLOCATE(S,IPIV,WORK,stat=error)
         IF (error.ne.0)THEN
           PRINT *,"error:fail to release memory"
           STOP
         END IF
+        !$OMP END PARALLEL
+        DEALLOCATE(full)
     END DO
+    DEALLOCATE(pfc,sf,onsite)
     !
-    END SUBROUTINE abcm
\ No newline at end of file
+    END SUBROUTINE abcm
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+NumPy version of the Fortran kernels in dyn_ewald.f90, used when the f2py
+extension is not compiled. The functions take the same arguments and give
+the same results, see the comments in dyn_ewald.f90. The sums are
+broadcast over the pair list or the mesh points, and done a chunk at a time
+so that the temporaries stay within BUDGET bytes; abcm also builds and
+eliminates the full ion+BC matrices a chunk of q-points at a time.
+'''
+import numpy as np
+from scipy.special import erfc
+from scipy.sparse import csr_matrix
+
+# the Fortran kernels use a single precision literal for pi
+PI = float(np.float32(3.1415927))
+BUDGET = 2**27
+
+def _chunk(size):
+    # number of items of the given size (bytes) within the budget
+    return max(1,int(BUDGET/max(size,1)))
+
+def _real_tensor(r,r2,alpha):
+    """
+    Second derivatives of erfc(alpha*r)/r for the vectors r (...,3) with
+    squared lengths r2 (...), returned with shape (...,3,3)
+    """
+    e = np.exp(-r2*alpha*alpha); sr = np.sqrt(r2); ec = erfc(alpha*sr)
+    rr = r[...,:,np.newaxis]*r[...,np.newaxis,:]
+    fc = -(4.*np.sqrt(PI)*alpha**3*r2*sr+6.*np.sqrt(PI)*alpha*sr)*e-3.*PI*ec
+    fc = fc[...,np.newaxis,np.newaxis]*rr/(PI*r2**2.5)[...,np.newaxis,np.newaxis]
+    diag = -2*alpha*e/np.sqrt(PI)/r2*(2*alpha**2+3/r2)
+    diag = diag[...,np.newaxis]*r**2 + (2.*alpha*e/np.sqrt(PI)/r2)[...,np.newaxis] \
+            + (ec/r2**1.5)[...,np.newaxis]*(1.-3.*r**2/r2[...,np.newaxis])
+    idx = np.arange(3)
+    fc[...,idx,idx] = diag
+    return fc
+
+def _kq(kmesh,qvec,start,stop):
+    # k+q of the q-points start:stop, nudged at k+q = 0 as in the kernels
+    nq = len(qvec)
+    k_q = kmesh[np.newaxis]+qvec[start:stop,np.newaxis]
+    small = np.sqrt((k_q**2).sum(axis=-1)) < 1e-10
+    for n0,nkk in zip(*np.nonzero(small)):
+        q = start+n0
+        if q < nq-1:
+            k_q[n0,nkk] += 1e-6*(qvec[q+1]-k_q[n0,nkk])
+        elif nq != 1:
+            k_q[n0,nkk] += 1e-6*(qvec[nq-2]-k_q[n0,nkk])
+        else:
+            k_q[n0,nkk] += 1e-6
+    return k_q
+
+def real_space(atoms,w,charge,rmesh,indptr,indices,images,alpha,qvec,dyn,onsite):
+    """
+    Add the real space sums over the pair list (CSR, see Ewald.get_pairs)
+    to dyn (nq,N,3,N,3) and onsite (N,3,3); either of them may be None
+    """
+    N = len(atoms); nq = len(qvec)
+    first = np.repeat(np.arange(N),np.diff(indptr))
+    # blocks of whole rows n1 with about step pairs each
+    step = _chunk((nq+2)*9*16)
+    lo = 0
+    while lo < N:
+        hi = max(np.searchsorted(indptr,indptr[lo]+step,side='right')-1,lo+1)
+        rows = slice(lo,hi); sel = slice(indptr[lo],indptr[hi]); lo = hi
+        n1 = first[sel]; n2 = indices[sel]; npair = len(n1)
+        r = atoms[n1]-atoms[n2]+rmesh[images[sel]]
+        if npair == 0: continue
+        r2 = (r**2).sum(axis=-1)
+        mask = r2 < 1e-4; r2[mask] = 1.
+        fc = _real_tensor(r,r2,alpha)
+        fc[mask] = 0.
+        fc *= (charge[n1]*charge[n2]/2.)[:,np.newaxis,np.newaxis]
+        if onsite is not None:
+            for a in range(3):
+                for b in range(3):
+                    onsite[:,a,b] -= np.bincount(n1,fc[:,a,b]*w[n1]**2,N)
+        if dyn is None: continue
+        fc *= (w[n1]*w[n2])[:,np.newaxis,np.newaxis]
+        # sum the images of each pair (n1,n2)
+        S = csr_matrix((np.ones(npair),((n1-rows.start)*N+n2,np.arange(npair))),\
+                shape=((rows.stop-rows.start)*N,npair))
+        ph = np.exp(-1j*np.dot(qvec,r.T)) # shape = nq,npair
+        tmp = S.dot((ph.T[:,:,np.newaxis,np.newaxis]*fc[:,np.newaxis]).reshape(npair,-1))
+        dyn[:,rows] += tmp.reshape(-1,N,nq,3,3).transpose(2,0,3,1,4)
+
+def add_onsite(dyn,onsite):
+    """
+    Add onsite (N,3,3) to the diagonal blocks of dyn (nq,N,3,N,3)
+    """
+    idx = np.arange(len(onsite))
+    # the advanced indices go first, i.e., shape = N,nq,3,3
+    dyn[:,idx,:,idx,:] += onsite[:,np.newaxis]
+
+def eliminate(full,mass):
+    """
+    Eliminate the bond charges of the full abcm matrices (nq,3N,3N) and
+    weight the ions by 1/sqrt(mass)
+    """
+    n = 3*len(mass)
+    R = full[:,:n,:n]; T = full[:,:n,n:]; Ts = full[:,n:,:n]; S = full[:,n:,n:]
+    dyn = R-np.matmul(T,np.linalg.solve(S,Ts)) if S.shape[-1] else R
+    msqrt = np.repeat(1./np.sqrt(mass),3)
+    return dyn*msqrt[:,np.newaxis]*msqrt
+
+def _prepare(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol):
+    """
+    The parts of ewald_full that do not depend on q.
+    return: onsite (N,3,3), sw (nk,N)
+        the onsite blocks and the weighted structure factors
+    """
+    N = len(atoms)
+    onsite = np.zeros((N,3,3),dtype=complex)
+    real_space(atoms,w,charge,rmesh,indptr,indices,images,alpha,np.zeros((0,3)),None,onsite)
+    # reciprocal space: q1*q2*EXP(j*k.(r1-r2)) = sf(k,n1)*CONJG(sf(k,n2))
+    sf = charge*np.exp(1j*np.dot(kmesh,atoms.T)) # shape = nk,N
+    rho = sf.sum(axis=1)
+    k2 = (kmesh**2).sum(axis=1)
+    kfac = np.zeros(len(kmesh))
+    mask = k2 > 1e-6
+    kfac[mask] = 4.*PI/k2[mask]*np.exp(-k2[mask]/4./alpha**2)/vol
+    kk = kmesh[:,:,np.newaxis]*kmesh[:,np.newaxis,:]*kfac[:,np.newaxis,np.newaxis]
+    onsite -= np.einsum('kab,kn->nab',kk,sf*np.conj(rho)[:,np.newaxis])*(w**2)[:,np.newaxis,np.newaxis]
+    return onsite, sf*w
+
+def _fill(dyn,onsite,sw,atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,\
+        qvec,start,stop):
+    """
+    Add the matrices of qvec[start:stop] to dyn (stop-start,N,3,N,3), with
+    onsite and sw from _prepare
+    """
+    N = len(atoms); nk = len(kmesh)
+    real_space(atoms,w,charge,rmesh,indptr,indices,images,alpha,qvec[start:stop],dyn,None)
+    step = _chunk(nk*(N+9)*16)
+    for q in range(start,stop,step):
+        k_q = _kq(kmesh,qvec,q,min(q+step,stop))
+        k_q2 = (k_q**2).sum(axis=-1)
+        G = k_q[...,:,np.newaxis]*k_q[...,np.newaxis,:]*\
+                (4.*PI/k_q2*np.exp(-k_q2/4./alpha**2)/vol)[...,np.newaxis,np.newaxis]
+        for a in range(3):
+            for b in range(3):
+                tmp = G[:,:,a,b,np.newaxis]*sw # shape = nqc,nk,N
+                dyn[q-start:q-start+step,:,a,:,b] += np.matmul(np.swapaxes(tmp,1,2),np.conj(sw))
+    add_onsite(dyn,onsite)
+
+def ewald_full(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec):
+    """
+    Full Coulomb matrices of all q-points with the atoms weighted by w,
+    i.e., 1/sqrt(mass) for vffm or 1 for abcm.
+    return: ndarray of shape (nq,3N,3N)
+    """
+    atoms,w,charge,rmesh,kmesh,qvec = [np.asarray(item,dtype=float) for item in \
+            (atoms,w,charge,rmesh,kmesh,qvec)]
+    N = len(atoms); nq = len(qvec)
+    onsite,sw = _prepare(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol)
+    dyn = np.zeros((nq,N,3,N,3),dtype=complex)
+    _fill(dyn,onsite,sw,atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,0,nq)
+    return dyn.reshape(nq,3*N,3*N)
+
+def vffm(atoms,mass,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,\
+        nthreads=0):
+    """
+    Same as dyn_ewald.vffm. nthreads is ignored.
+    """
+    return ewald_full(atoms,1./np.sqrt(mass),charge,rmesh,indptr,indices,images,\
+            kmesh,alpha,vol,qvec)
+
+def full(atoms,charge,rmesh,indptr,indices,images,\
+        kmesh,alpha,vol,qvec,nthreads=0):
+    """
+    Same as dyn_ewald.full. nthreads is ignored.
+    """
+    return ewald_full(atoms,np.ones(len(atoms)),charge,rmesh,indptr,indices,images,\
+            kmesh,alpha,vol,qvec)
+
+def abcm(atoms,mass,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,qvec,\
+        nthreads=0):
+    """
+    Same as dyn_ewald.abcm. nthreads is ignored. The full ion+BC matrices
+    are built and eliminated a block of q-points at a time within BUDGET.
+    """
+    atoms,mass,charge,rmesh,kmesh,qvec = [np.asarray(item,dtype=float) for item in \
+            (atoms,mass,charge,rmesh,kmesh,qvec)]
+    N = len(atoms); nq = len(qvec); n = 3*len(mass); w = np.ones(N)
+    onsite,sw = _prepare(atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol)
+    dyn = np.zeros((nq,n,n),dtype=complex)
+    step = _chunk(9*N*N*16)
+    for q in range(0,nq,step):
+        stop = min(q+step,nq)
+        full = np.zeros((stop-q,N,3,N,3),dtype=complex)
+        _fill(full,onsite,sw,atoms,w,charge,rmesh,indptr,indices,images,kmesh,alpha,vol,\
+                qvec,q,stop)
+        dyn[q:stop] = eliminate(full.reshape(stop-q,3*N,3*N),mass)
+    return dyn
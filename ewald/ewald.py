@@ -14,15 +14,82 @@ Physics, 109(18), 7678. doi:10.1063/1.477414
 2014-08-15: Add Fortran extension that calculates the dynamical matrix and a few
             modifications.
 Mon Sep  1 17:07:57 2014: Replace loops with mesh grid
+The NumPy kernels in dyn_numpy are used if the Fortran extension is not compiled.
+The reciprocal sums can be done with smooth particle-mesh Ewald (spme) instead.
 '''
 
+import os
+import hashlib
+from collections import OrderedDict
 import numpy as np
 from numpy.linalg import inv
 from scipy.special import erfc
-from dyn_ewald import vffm,abcm
+from scipy.spatial import cKDTree
+import dyn_numpy
+import spme
+from ..backends import register,select,call
+try:
+    import dyn_ewald
+except ImportError:
+    dyn_ewald = None
 M_PROTON = 1.67262178E-27   # kg
 THZ = 1.0E+12          # s^-1
 M_THZ = 1.0/M_PROTON/THZ/THZ
+def _kernel(module):
+    # the kernels of all modes in one function, see Ewald.get_dyn
+    def ewald(mode,atoms,mass,*args):
+        if mode == "full": return module.full(atoms,*args)
+        return getattr(module,mode)(atoms,mass,*args)
+    return ewald
+
+register("ewald","fortran",None if dyn_ewald == None else _kernel(dyn_ewald))
+register("ewald","numpy",_kernel(dyn_numpy))
+
+# without a cutoff, the real space terms of the dynamical matrix below RTOL
+# are dropped
+RTOL = 1.0E-20
+
+class DynCache(object):
+    '''
+    Least recently used cache of dynamical matrices. The ones that fit in
+    maxsize bytes are kept in memory. If path is given, all of them are
+    also saved there as key.npy, and the ones not in memory are read back
+    memory-mapped. All of them are made read-only.
+    '''
+    def __init__(self, maxsize=2**28, path=None):
+        self.maxsize = maxsize; self.path = path
+        self.data = OrderedDict(); self.size = 0
+        if path != None and not os.path.isdir(path): os.makedirs(path)
+
+    def get(self, key):
+        '''
+        return: the matrix or None
+        '''
+        if key in self.data:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+        if self.path != None:
+            fname = os.path.join(self.path,key+".npy")
+            if os.path.isfile(fname):
+                return np.load(fname,mmap_mode='r')
+        return None
+
+    def put(self, key, value):
+        value.flags.writeable = False
+        if self.path != None:
+            fname = os.path.join(self.path,key+".npy")
+            if not os.path.isfile(fname):
+                # renamed when complete, other processes may read it any time
+                tmp = "%s.%d.tmp" % (fname,os.getpid())
+                with open(tmp,"wb") as f:
+                    np.save(f,value)
+                os.rename(tmp,fname)
+        if value.nbytes <= self.maxsize:
+            if key in self.data: self.size -= self.data.pop(key).nbytes
+            self.data[key] = value; self.size += value.nbytes
+            while self.size > self.maxsize:
+                self.size -= self.data.popitem(last=False)[1].nbytes
 
 class Ewald(object):
     '''
@@ -36,8 +103,10 @@ class Ewald(object):
     rgrid : real space grid, integer
     kgrid : reciprocal space grid, integer
     alpha : Ewald parameter. Has a default value.
+    accuracy : if given, spherical meshes are chosen for this relative
+               accuracy instead of the grids, see set_accuracy
     '''
-    def __init__(self, lvec, basis, charge, rgrid, kgrid, alpha=None):
+    def __init__(self, lvec, basis, charge, rgrid, kgrid, alpha=None, accuracy=None):
         # Validation of array inputs
         self.lvec, self.bas, self.cha, self.alp = \
             map(np.array, (lvec, basis, charge, alpha))
@@ -45,9 +114,6 @@ class Ewald(object):
         assert len(self.bas) == len(self.cha)
         if np.sum(self.cha) != 0:
             print "Warning: sum of charges is not zero!"
-        rgrid, kgrid = map(np.array, (rgrid, kgrid))
-        assert rgrid.shape == (3,)
-        assert kgrid.shape == (3,)
         # calculate the unit cell volume and reciprocal lattice vector
         self.v = abs(np.inner(np.cross(self.lvec[0], self.lvec[1]), self.lvec[2]))
         self.rvec = 2*np.pi*inv(lvec).T # must come with transpose
@@ -56,8 +122,32 @@ class Ewald(object):
             self.alp = 1.3 / np.power(self.v,1.0/3.0)
         assert self.alp >= 0.0
         # initialize the r and k mesh
-        self.set_kmesh(kgrid)
-        self.set_rmesh(rgrid)
+        self.rcut = None; self.kcut = None; self.pairs = None
+        if accuracy == None:
+            rgrid, kgrid = map(np.array, (rgrid, kgrid))
+            assert rgrid.shape == (3,)
+            assert kgrid.shape == (3,)
+            self.set_kmesh(kgrid)
+            self.set_rmesh(rgrid)
+        else:
+            self.set_accuracy(accuracy,alpha)
+        # OpenMP threads of the Fortran kernels, None for the default
+        self.nthreads = None
+        # default method of get_dyn and the spme parameters
+        self.method = "ewald"
+        self.set_spme()
+        self.set_cache()
+
+    def __setstate__(self, state):
+        # objects pickled before the pair list, the OpenMP threads, the
+        # spme method and the cache were added
+        self.__dict__.update(state)
+        if "method" not in state:
+            self.rcut = None; self.kcut = None; self.pairs = None
+            self.nthreads = None
+            self.method = "ewald"
+            self.set_spme()
+            self.set_cache()
         
     def _set_es(self):
         '''
@@ -69,32 +159,48 @@ class Ewald(object):
         '''
         compute the energy contribution from reciprocal space
         '''
-        ekmesh = np.zeros(len(self.kmesh))
-        rho = np.zeros(len(self.kmesh),dtype=complex)
-        k2 = (self.kmesh**2).sum(axis=1)
-        # workaround the zero limbo
-        mask = (k2<1e-4); k2 += 1.e4*mask
-        for i in range(len(self.bas)):
-            kr = np.dot(self.kmesh,self.bas[i])
-            rho += self.cha[i]*np.exp(-1j*kr)
-        ekmesh = np.abs(rho)**2/k2*np.exp(-k2/4.0/self.alp**2)
-        self.ek = 2.*np.pi/self.v*ekmesh.sum()
+        self.ek = 0.0
+        for k,kfac in self._k_chunks():
+            rho = np.exp(-1j*np.dot(k,self.bas.T)).dot(self.cha)
+            self.ek += 0.5*(np.abs(rho)**2*kfac).sum()
 
     def _set_er(self):
         '''
         compute the energy contribution from real space
         '''
-        ermesh = np.zeros(len(self.rmesh))
-        for i in range(len(self.bas)):
-            for j in range(len(self.bas)):
-                q1 = self.cha[i]; q2 = self.cha[j]
-                r = self.bas[i] - self.bas[j] + self.rmesh
-                r2 = np.sum(r**2,axis=1)
-                # workaround the zero limbo
-                mask = (r2<1e-4); r2 += 1.e4*mask
-                ermesh += q1*q2*erfc(self.alp*np.sqrt(r2))/np.sqrt(r2)
-        self.er = 0.5*ermesh.sum()
-        
+        self.er = 0.0
+        for i,r,r2,q12 in self._r_chunks():
+            self.er += 0.5*(q12*erfc(self.alp*np.sqrt(r2))/np.sqrt(r2)).sum()
+
+    def _k_chunks(self):
+        '''
+        kmesh a chunk at a time, together with 4*pi/V*exp(-k^2/4/alpha^2)/k^2,
+        which is 0 for k = 0
+        '''
+        step = dyn_numpy._chunk(len(self.bas)*16*4)
+        for i in range(0,len(self.kmesh),step):
+            k = self.kmesh[i:i+step]
+            k2 = (k**2).sum(axis=1)
+            kfac = np.zeros(len(k))
+            mask = k2 >= 1e-4
+            kfac[mask] = 4.*np.pi/self.v/k2[mask]*np.exp(-k2[mask]/4.0/self.alp**2)
+            yield k,kfac
+
+    def _r_chunks(self):
+        '''
+        r = r_i-r_j+R of a block of rows i at a time, with the shape
+        (rows,N,nr,3), r2 and q_i*q_j, where q_i*q_j is 0 for r = 0
+        '''
+        N = len(self.bas)
+        rows = dyn_numpy._chunk(N*len(self.rmesh)*8*8)
+        for i in range(0,N,rows):
+            r = self.bas[i:i+rows,np.newaxis,np.newaxis]-self.bas[:,np.newaxis]+self.rmesh
+            r2 = (r**2).sum(axis=-1)
+            # workaround the zero limbo
+            mask = r2 < 1e-4; r2[mask] = 1.
+            q12 = np.outer(self.cha[i:i+rows],self.cha)[:,:,np.newaxis]*~mask
+            yield i,r,r2,q12
+
     def get_etot(self):
         '''
         compute the total energy
@@ -120,57 +226,145 @@ class Ewald(object):
         self._gen_grid(kgrid,2)
     def set_rmesh(self,rgrid):
         self._gen_grid(rgrid,1)
+        self.pairs = None
+
+    def _gen_sphere(self, vecs, cut):
+        '''
+        all lattice vectors n.vecs with length <= cut
+        '''
+        # |n_i| <= cut*|row i of the dual basis|
+        dual = inv(vecs).T
+        X,Y,Z = np.ceil(cut*np.sqrt((dual**2).sum(axis=1))).astype(int)
+        x,y,z = np.mgrid[-X:X+1, -Y:Y+1, -Z:Z+1]
+        xyz = np.asarray((x.reshape(-1),y.reshape(-1),z.reshape(-1))).T
+        mesh = xyz.dot(vecs)
+        return mesh[(mesh**2).sum(axis=1) <= cut**2+1e-10]
+
+    def set_accuracy(self, accuracy, alpha=None):
+        '''
+        Choose the cutoffs for a relative accuracy of both sums, exp(-s^2) =
+        accuracy with s = kcut/2/alpha, while rcut is a bit longer than
+        s/alpha for the slower decay of the force constants. alpha is kept, unless
+        given, because the real space term of the dynamical matrix kernels
+        is weighted by 1/2 and their sum depends on it. The meshes are
+        spheres instead of boxes: the real space one is padded by the
+        largest distance within the basis and the reciprocal one by the
+        radius of the Brillouin zone, since the kernels sum over r_i-r_j+R
+        and k+q.
+        '''
+        if not 0.0 < accuracy < 1.0:
+            raise ValueError("accuracy should be in (0,1)!")
+        if alpha != None: self.alp = alpha
+        s = np.sqrt(-np.log(accuracy))
+        # the real space terms of the dynamical matrix go as (alpha*r)^2*exp(-s^2)
+        self.rcut = np.sqrt(s**2+np.log(1.+s**2))/self.alp; self.kcut = 2.*self.alp*s
+        dist = self.bas.reshape(-1,1,3)-self.bas
+        dmax = np.sqrt((dist**2).sum(axis=-1).max())
+        qmax = 0.5*np.sqrt((self.rvec**2).sum(axis=1)).sum()
+        self.rmesh = self._gen_sphere(self.lvec,self.rcut+dmax)
+        self.pairs = None
+        self.kmesh = self._gen_sphere(self.rvec,self.kcut+qmax)
+
+    def get_pairs(self):
+        '''
+        Real space pair list of the dynamical matrix in CSR form: the images
+        r = r_n1-r_n2+R with R in rmesh and |r| <= rcut, or where the terms
+        drop below RTOL if rcut is not set. It is found with a KD-tree over
+        the images, so the cost is linear in N instead of N^2, and kept until
+        rmesh, rcut or alpha change.
+        return: indptr (N+1,), indices (npair,), images (npair,)
+            the images of n1 are n2 = indices[indptr[n1]:indptr[n1+1]] with
+            R = rmesh[images[...]], all int32
+        '''
+        cut = self.rcut if self.rcut != None else np.sqrt(-np.log(RTOL))/self.alp
+        if self.pairs != None and self.pairs[0] == cut:
+            return self.pairs[1:]
+        N = len(self.bas); nr = len(self.rmesh)
+        # image R*N+n2 is r_n2-R
+        points = cKDTree((self.bas[np.newaxis]-self.rmesh[:,np.newaxis]).reshape(-1,3))
+        # a block of rows n1 at a time, at most N*nr pairs each
+        rows = dyn_numpy._chunk(N*nr*48)
+        count = []; indices = []; images = []
+        for i in range(0,N,rows):
+            found = cKDTree(self.bas[i:i+rows]).sparse_distance_matrix(points,cut,\
+                    output_type='ndarray')
+            # sorted by n1, n2 and then R
+            n1 = found['i']; n2 = found['j']%N; R = found['j']//N
+            order = np.argsort((n1*N+n2)*nr+R)
+            count.append(np.bincount(n1,minlength=len(self.bas[i:i+rows])))
+            indices.append(n2[order].astype(np.int32))
+            images.append(R[order].astype(np.int32))
+        indptr = np.concatenate(([0],np.cumsum(np.concatenate(count))))
+        self.pairs = (cut,indptr.astype(np.int32),np.concatenate(indices),\
+                np.concatenate(images))
+        return self.pairs[1:]
+
+    def set_spme(self, grid=None, order=6):
+        '''
+        FFT grid (3 integers) and even B-spline order of the spme method,
+        the grid is derived from kmesh if not given
+        '''
+        if order % 2:
+            raise ValueError("order of the B-splines should be even!")
+        self.spme_grid = grid; self.spme_order = order
 
-    def get_force(self):
+    def set_cache(self, maxsize=2**28, path=None):
+        '''
+        Keep the matrices of get_dyn in a DynCache of maxsize bytes in
+        memory and, if path is given, also on disk. The matrices are keyed
+        by a hash of everything they depend on, so a cache directory can be
+        shared by any structure. maxsize = 0 and no path turns it off.
+        '''
+        if maxsize == 0 and path == None:
+            self.cache = None
+        else:
+            self.cache = DynCache(maxsize,path)
+
+    def _dyn_key(self, mode, method, gamma):
+        '''
+        hash of the inputs of get_dyn, self.mass and self.qvec are set
+        '''
+        h = hashlib.sha1()
+        for item in (self.lvec,self.bas,self.cha,self.alp,self.rmesh,self.kmesh,\
+                self.mass,self.qvec):
+            item = np.ascontiguousarray(item,dtype=float)
+            h.update(str(item.shape)); h.update(item.tobytes())
+        h.update(str((mode,method,gamma,self.rcut,RTOL)))
+        if method == "spme": h.update(str((self.spme_grid,self.spme_order)))
+        return h.hexdigest()
+
+    def get_force(self,verbose=True):
         '''
         compute the forces on each ion and store them in self.force;
         forces are only due to energy from real and reciprocal space;
         no force is due to the self-energy.
+        verbose: boolean (default:True)
+            print out the forces
         '''
-        # initiate forces storage
-        self.force = np.zeros(shape=(len(self.bas),3))
-
-        for i in range(len(self.bas)):
-            for j in range(len(self.bas)):
-                # compute the contribution from the k-space first
-                sumk = 0
-
-                k2 = (self.kmesh**2).sum(axis=1)
-                # workaround the zero limbo
-                mask = (k2<1e-4); k2 += 1.e4*mask
-                kr = np.dot(self.kmesh,self.bas[i]-self.bas[j])
-                fk = 4*np.pi/k2*np.exp(-k2/4./self.alp**2)*np.sin(kr)
-                kx,ky,kz = self.kmesh.T
-                tmp = np.asarray((fk*kx,fk*ky,fk*kz))/self.v
-                sumk = tmp.T.sum(axis=0)
-                # print 'k contribute', sumk
-
-                # compute the contribution from the r-space then
-                sumr = 0
-                r = self.bas[i] - self.bas[j] + self.rmesh
-                r2 = np.sum(r**2,axis=1)
-                # workaround the zero limbo
-                mask = (r2<1e-4); r2 += 1.e4*mask
-                fr = 2.*self.alp/np.sqrt(np.pi)*np.exp(-self.alp**2*r2)
-                fr += erfc(self.alp*np.sqrt(r2))/np.sqrt(r2)
-                fr /= r2
-                rx,ry,rz = r.T
-                tmp = np.asarray((fr*rx,fr*ry,fr*rz))
-                sumr = tmp.T.sum(axis=0)
-                # print 'r contribute', sumr
-
-                # scale the force with q_j
-                self.force[i] += (sumk+sumr)*self.cha[j]
-            # scale the force with q_i
-            self.force[i] *= self.cha[i]
-        # Kindly print out the forces in good format
-        for i in range(len(self.bas)):
-            print "Force acts on ion %d is : %8.4f %8.4f %8.4f" % \
-                (i,self.force[i][0],self.force[i][1],self.force[i][2])
+        N = len(self.bas)
+        self.force = np.zeros(shape=(N,3))
+        # reciprocal space: sum_j q_j*sin(k.(r_i-r_j)) = Im(EXP(j*k.r_i)*rho(k))
+        for k,kfac in self._k_chunks():
+            sf = np.exp(1j*np.dot(k,self.bas.T)) # shape = nk,N
+            rho = np.conj(sf).dot(self.cha)
+            fk = (sf*rho[:,np.newaxis]).imag*kfac[:,np.newaxis]
+            self.force += np.dot(fk.T,k)*self.cha[:,np.newaxis]
+        # real space
+        for i,r,r2,q12 in self._r_chunks():
+            fr = 2.*self.alp/np.sqrt(np.pi)*np.exp(-self.alp**2*r2)
+            fr += erfc(self.alp*np.sqrt(r2))/np.sqrt(r2)
+            fr *= q12/r2
+            self.force[i:i+len(r)] += np.einsum('ijr,ijra->ia',fr,r)
+        if verbose:
+            # Kindly print out the forces in good format
+            for i in range(N):
+                print "Force acts on ion %d is : %8.4f %8.4f %8.4f" % \
+                    (i,self.force[i][0],self.force[i][1],self.force[i][2])
 
         return self.force
 
-    def get_dyn(self,mass,qvec,crys=True,mode="vffm"):
+    def get_dyn(self,mass,qvec,crys=True,mode="vffm",gamma=False,nthreads=None,backend=None,
+            method=None):
         """
         Calculate the equation of motion under harmonic approximation.
         Return the dynamical matrix at a specific q point.
@@ -182,23 +376,66 @@ class Ewald(object):
               if true, qvec is in reciprocal lattice unit;
               otherwise, in unit of 2pi/alat
         mode: str
-              either "vffm" or "abcm"
+              "vffm", "abcm", or "full" for the ion+BC matrices of abcm
+              before the BCs are eliminated, not weighted by the masses
+              nor scaled by M_THZ, i.e., in the unit of DynBuildFull
+        gamma: boolean (default:False)
+              all qvec are Gamma, where all phases are 1 and the matrix
+              is real, float64 is returned
+        nthreads: int
+              number of OpenMP threads if the extension is compiled with
+              OpenMP, default is self.nthreads, then OMP_NUM_THREADS
+        backend: str
+              "fortran" or "numpy", default is "fortran" if dyn_ewald is
+              compiled, otherwise "numpy", see backends
+        method: str
+              "ewald" for the sums over kmesh, or "spme" for the smooth
+              particle-mesh Ewald on a FFT grid, see set_spme, which scales
+              as N*log(N) instead of N^2 per column and is meant for big
+              supercells; backend and nthreads are ignored. Default is
+              self.method
+        return: the matrices are read-only if self.cache is set, see
+              set_cache
         """
         self.mass, qvec = map(np.array, (mass, qvec))
         if mode == "vffm":
             if self.mass.shape != self.cha.shape:
                 raise ValueError('shape(mass) does not match!')
-        elif mode == "abcm":
-            pass
-        else:
-            raise ValueError("Wrong mode! Need to be either abcm or vffm")
+        elif mode not in ("abcm","full"):
+            raise ValueError("Wrong mode! Need to be either abcm, vffm or full")
         if qvec.shape == (3,): qvec = np.array([qvec])
+        if gamma and np.any(qvec):
+            raise ValueError("gamma=True but not all qvec are Gamma!")
         nks = len(qvec); N = len(self.mass)
         self.qvec = qvec.dot(self.rvec) if crys else qvec*2.*np.pi
-        if mode == "vffm":
-            self.dyn = vffm(self.bas,self.mass,self.cha,self.rmesh,\
-                    self.kmesh,self.alp,self.v,self.qvec)*self.v*M_THZ
-        elif mode == "abcm":
-            self.dyn = abcm(self.bas,self.mass,self.cha,self.rmesh,\
-                    self.kmesh,self.alp,self.v,self.qvec)*self.v*M_THZ
+        if nthreads == None: nthreads = self.nthreads
+        if nthreads == None: nthreads = 0
+        if method == None: method = self.method
+        if method not in ("ewald","spme"):
+            raise ValueError("Wrong method! Need to be either ewald or spme")
+        if method == "ewald": backend = select("ewald",backend)
+        if self.cache != None:
+            key = self._dyn_key(mode,method,gamma)
+            self.dyn = self.cache.get(key)
+            if self.dyn is not None: return self.dyn
+        indptr,indices,images = self.get_pairs()
+        if method == "spme":
+            grid = self.spme_grid
+            if grid == None: grid = spme.grid_size(self.lvec,self.kmesh,self.spme_order)
+            if mode == "full":
+                self.dyn = spme.full(self.bas,self.cha,self.rmesh,indptr,indices,images,\
+                        self.lvec,grid,self.spme_order,self.alp,self.v,self.qvec)*self.v
+            else:
+                self.dyn = getattr(spme,mode)(self.bas,self.mass,self.cha,self.rmesh,\
+                        indptr,indices,images,self.lvec,grid,self.spme_order,self.alp,\
+                        self.v,self.qvec)*self.v*M_THZ
+        else:
+            self.dyn = call("ewald",mode,self.bas,self.mass,self.cha,self.rmesh,indptr,\
+                    indices,images,self.kmesh,self.alp,self.v,self.qvec,nthreads,\
+                    backend=backend)*self.v
+            if mode != "full": self.dyn *= M_THZ
+        # the imaginary part at Gamma is only rounding noise of the
+        # symmetric kmesh sums
+        if gamma: self.dyn = np.ascontiguousarray(self.dyn.real)
+        if self.cache != None: self.cache.put(key,self.dyn)
         return self.dyn
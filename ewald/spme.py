@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+Smooth particle-mesh Ewald (SPME) version of the kernels in dyn_numpy. The
+real space sums are the same, while the reciprocal ones are done on a FFT
+grid: the structure factors EXP(j*G.r) are interpolated by cardinal
+B-splines of the given (even) order, so a column of the reciprocal matrix is
+one convolution on the grid, i.e., O(K log K) instead of O(N*nk), K being the
+number of grid points.
+Essmann, U., Perera, L., Berkowitz, M. L., Darden, T., Lee, H., & Pedersen,
+L. G. (1995). A smooth particle mesh Ewald method. The Journal of Chemical
+Physics, 103(19), 8577. doi:10.1063/1.470117
+'''
+import numpy as np
+from numpy.fft import fftn, ifftn
+import dyn_numpy
+from dyn_numpy import PI, _chunk, _kq
+
+def _cardinal(order,t):
+    # cardinal B-spline M_order(t), nonzero for 0 < t < order
+    if order == 2:
+        return np.maximum(0.,1.-abs(t-1.))
+    return (t*_cardinal(order-1,t)+(order-t)*_cardinal(order-1,t-1.))/(order-1)
+
+def _bmod2(K,order):
+    # |b(m)|^2 of the Euler exponential splines, for m in the FFT order
+    m = np.fft.fftfreq(K)*K
+    k = np.arange(order-1)
+    den = np.abs(np.exp(2j*np.pi*np.outer(m,k)/K).dot(_cardinal(order,k+1.)))**2
+    return np.where(den > 1e-10,1./np.maximum(den,1e-10),0.)
+
+def grid_size(lvec,kmesh,order=6):
+    """
+    FFT grid that holds the reciprocal vectors of kmesh with some room for
+    the interpolation, rounded up to products of 2, 3 and 5
+    """
+    m = np.abs(np.rint(np.dot(kmesh,np.transpose(lvec))/2./np.pi)).max(axis=0)
+    grid = []
+    for n in 2*(2*m.astype(int)+1):
+        n = max(n,order)
+        while True:
+            rest = n
+            for p in (2,3,5):
+                while rest % p == 0: rest /= p
+            if rest == 1: break
+            n += 1
+        grid.append(n)
+    return grid
+
+def spline_weights(atoms,lvec,grid,order):
+    """
+    Grid points and B-spline weights of each atom.
+    return: idx, weight
+        flat grid indices and weights, both of shape (N,order**3)
+    """
+    u = np.dot(atoms,np.linalg.inv(lvec))*grid # scaled fractional coordinates
+    base = np.floor(u).astype(int)
+    j = np.arange(order)
+    # point base-j gets M(u-base+j)
+    w = _cardinal(order,(u-base)[:,:,np.newaxis]+j) # shape = N,3,order
+    p = (base[:,:,np.newaxis]-j) % np.asarray(grid)[:,np.newaxis]
+    idx = (p[:,0,:,np.newaxis,np.newaxis]*grid[1]+p[:,1,np.newaxis,:,np.newaxis])*grid[2]\
+            +p[:,2,np.newaxis,np.newaxis,:]
+    weight = w[:,0,:,np.newaxis,np.newaxis]*w[:,1,np.newaxis,:,np.newaxis]*\
+            w[:,2,np.newaxis,np.newaxis,:]
+    N = len(atoms)
+    return idx.reshape(N,-1), weight.reshape(N,-1)
+
+def _influence(kvec,bmod2,alpha,vol,tol=0.):
+    # 4*PI/V*EXP(-k^2/4/alpha^2)/k^2*k_a*k_b*|b|^2 without k^2 <= tol,
+    # shape = 3,3,grid
+    k2 = (kvec**2).sum(axis=-1)
+    mask = k2 > tol
+    g = np.zeros(k2.shape)
+    g[mask] = 4.*PI/k2[mask]*np.exp(-k2[mask]/4./alpha**2)/vol
+    g *= bmod2
+    return np.einsum('...a,...b,...->ab...',kvec,kvec,g)
+
+def _convolve(H,idx,weight,scale,cols):
+    # (P^T conv(H) P)[:,cols] with P the scaled spline weights on the grid
+    shape = H.shape[2:]; size = np.prod(shape); N = len(idx)
+    p = np.zeros((len(cols),size))
+    rows = np.arange(len(cols))[:,np.newaxis]
+    np.add.at(p,(rows,idx[cols]),weight[cols]*scale[cols,np.newaxis])
+    ft = fftn(p.reshape((len(cols),)+shape),axes=(1,2,3))
+    out = np.zeros((N,3,len(cols),3),dtype=complex)
+    for a in range(3):
+        for b in range(a,3):
+            y = ifftn(H[a,b]*ft,axes=(1,2,3)).reshape(len(cols),-1)*size
+            out[:,a,:,b] = np.einsum('ns,cns->nc',weight*scale[:,np.newaxis],y[:,idx])
+            if b != a: out[:,b,:,a] = out[:,a,:,b]
+    return out
+
+def ewald_full(atoms,w,charge,rmesh,indptr,indices,images,lvec,grid,order,alpha,vol,\
+        qvec):
+    """
+    Same as dyn_numpy.ewald_full with the reciprocal sums over the FFT grid
+    (3 integers) instead of kmesh.
+    return: ndarray of shape (nq,3N,3N)
+    """
+    atoms,w,charge,rmesh,lvec,qvec = [np.asarray(item,dtype=float) for item in \
+            (atoms,w,charge,rmesh,lvec,qvec)]
+    if order % 2:
+        raise ValueError("order of the B-splines should be even!")
+    N = len(atoms); nq = len(qvec); grid = list(grid)
+    dyn = np.zeros((nq,N,3,N,3),dtype=complex)
+    onsite = np.zeros((N,3,3),dtype=complex)
+    dyn_numpy.real_space(atoms,w,charge,rmesh,indptr,indices,images,alpha,qvec,dyn,onsite)
+    idx,weight = spline_weights(atoms,lvec,grid,order)
+    b = [_bmod2(K,order) for K in grid]
+    bmod2 = b[0][:,np.newaxis,np.newaxis]*b[1][:,np.newaxis]*b[2]
+    m = np.array(np.meshgrid(*[np.fft.fftfreq(K)*K for K in grid],indexing='ij'))
+    G = np.dot(np.moveaxis(m,0,-1),2*np.pi*np.linalg.inv(lvec).T) # shape = grid+(3,)
+    # onsite: the q = 0 matrix times the total charge, without G = 0
+    H = _influence(G,bmod2,alpha,vol,1e-6)
+    rho = np.zeros(np.prod(grid))
+    np.add.at(rho,idx,weight*charge[:,np.newaxis])
+    y = [[ifftn(H[a,c]*fftn(rho.reshape(grid))).reshape(-1)*rho.size for c in range(3)] \
+            for a in range(3)]
+    for a in range(3):
+        for c in range(3):
+            onsite[:,a,c] -= (weight*y[a][c][idx]).sum(axis=1)*charge*w**2
+    # the columns of each q-point are done a block at a time
+    scale = charge*w
+    cols = _chunk(np.prod(grid)*16*4+N*order**3*16)
+    for q in range(nq):
+        k_q = _kq(G.reshape(-1,3),qvec,q,q+1)[0].reshape(G.shape)
+        H = _influence(k_q,bmod2,alpha,vol)
+        for i in range(0,N,cols):
+            sel = np.arange(i,min(i+cols,N))
+            dyn[q,:,:,sel[0]:sel[-1]+1] += _convolve(H,idx,weight,scale,sel)
+    dyn_numpy.add_onsite(dyn,onsite)
+    return dyn.reshape(nq,3*N,3*N)
+
+def vffm(atoms,mass,charge,rmesh,indptr,indices,images,lvec,grid,order,alpha,vol,qvec):
+    """
+    Same as dyn_numpy.vffm with SPME.
+    """
+    return ewald_full(atoms,1./np.sqrt(mass),charge,rmesh,indptr,indices,images,\
+            lvec,grid,order,alpha,vol,qvec)
+
+def full(atoms,charge,rmesh,indptr,indices,images,\
+        lvec,grid,order,alpha,vol,qvec):
+    """
+    Same as dyn_numpy.full with SPME.
+    """
+    return ewald_full(atoms,np.ones(len(atoms)),charge,rmesh,indptr,indices,images,\
+            lvec,grid,order,alpha,vol,qvec)
+
+def abcm(atoms,mass,charge,rmesh,indptr,indices,images,lvec,grid,order,alpha,vol,qvec):
+    """
+    Same as dyn_numpy.abcm with SPME.
+    """
+    full = ewald_full(atoms,np.ones(len(atoms)),charge,rmesh,indptr,indices,images,\
+            lvec,grid,order,alpha,vol,qvec)
+    return dyn_numpy.eliminate(full,mass)
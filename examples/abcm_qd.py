@@ -55,5 +55,6 @@ for r0 in r:
     calc.set_nn(dist2=0.5)
     calc.set_fc(fc_dict)
     calc.set_kpts(kpts,crys=True)
-    print calc.get_ph_disp()
+    # print calc.get_ph_disp() # dense, out of reach for the larger dots
+    print calc.get_ph_sparse(nev=30,evec=False)[0] # lowest 30 modes
     calc.save(name)
\ No newline at end of file
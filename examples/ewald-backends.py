@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Check the Fortran and NumPy Ewald kernels against each other on GaAs along a
+k-path, for the vffm, abcm and full modes. With backends.set_check every
+get_dyn also runs the other available backend and raises ValueError if the
+two differ by more than TOL, so the script fails on a mismatch.
+"""
+import sys
+import time
+import numpy as np
+from Latdyn import Ewald,BulkBuilder,default_k_path
+from Latdyn import backends
+
+TOL = 1e-8
+if len(sys.argv) > 1: TOL = float(sys.argv[1])
+
+r12 = 1.5
+cc = 4*r12*r12/(1+r12*r12); ca = 4 - cc
+a,b,bc,symion,symbc = BulkBuilder("diamond",withBC=True,r12=r12)
+basis = np.vstack((b,bc))
+mass = {"abcm":[69.723,74.92160],"full":[69.723,74.92160],
+        "vffm":[69.723,74.92160,1.,1.,1.,1.]}
+calc = Ewald(lvec=a,basis=basis,charge=[cc,ca,-1,-1,-1,-1],rgrid=[2,2,2],kgrid=[2,2,2])
+calc.set_cache(0) # recompute every call, so both backends really run
+kpts,point_names,x,X = default_k_path("fcc",a,num=50)
+
+if len(backends.available("ewald")) < 2:
+    print "Only the %s backend is available, nothing to compare" % backends.available("ewald")[0]
+    sys.exit(0)
+backends.set_check(TOL)
+for mode in ["vffm","abcm","full"]:
+    t0 = time.time()
+    calc.get_dyn(mass[mode],kpts,mode=mode)
+    print "%-5s OK %8.3f s" % (mode,time.time()-t0)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+VFFM of GaAs up to the 2nd n.n. with set_fc in the format of its docstring.
+The script fails if the dict is not accepted or if the three acoustic
+modes at Gamma are not zero.
+"""
+import numpy as np
+from Latdyn import VFFM,BulkBuilder,default_k_path
+
+a,b,bc,symion,symbc = BulkBuilder("diamond",withBC=True,r12=1.)
+calc = VFFM(lvec=a,basis=b,mass=[69.723,74.92160],symbol=["Ga","As"])
+calc.set_nn(dist2=0.75)
+calc.get_nn_label()
+
+fc_dict = {"alpha":{"Ga-As":40.,"Ga-Ga2":4.,"As-As2":3.5},
+        "beta":{"Ga-As":5.,"Ga-Ga2":0.7,"As-As2":0.6}}
+calc.set_fc(fc_dict)
+kpts,point_names,x,X = default_k_path("fcc",a,num=50)
+calc.set_kpts(kpts)
+freq = calc.get_ph_disp(evec=False)
+print "Frequencies at Gamma [THz]:", freq[0]
+if not np.abs(np.sort(freq[0])[:3]).max() < 1e-5:
+    raise ValueError("The acoustic modes at Gamma are not zero!")
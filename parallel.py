@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Process-pool engine for k-point parallelism. The k-points are split into
+chunks, and each chunk is built and diagonalised by a worker process. The
+workers are forked, so the model itself is inherited rather than pickled,
+and each one is pinned to a single BLAS thread since the matrices are too
+small for threaded BLAS to pay off.
+Nothing big goes through pickles: the workers only read the inputs, e.g.,
+bas and the BondTable arrays, so their pages stay shared with the parent
+(copy-on-write), and they write frequencies and eigenvectors straight into
+shared output arrays.
+"""
+import os
+import mmap
+import ctypes
+import multiprocessing as mp
+import numpy as np
+
+BLAS_THREADS = ("OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS",
+                "VECLIB_MAXIMUM_THREADS","NUMEXPR_NUM_THREADS")
+BLAS_SETTERS = ("openblas_set_num_threads","openblas_set_num_threads64_",
+                "MKL_Set_Num_Threads","bli_thread_set_num_threads")
+
+# the job that forked workers inherit: (calc,kpts,crys,evec,outputs)
+_job = None
+
+def SharedArray(shape,dtype=float):
+    """
+    NumPy array on an anonymous shared memory map. Forked workers inherit
+    the mapping, so what they write is seen by the parent without any
+    serialisation.
+    """
+    dtype = np.dtype(dtype); size = int(np.prod(shape))
+    buf = mmap.mmap(-1,max(size*dtype.itemsize,1))
+    return np.frombuffer(buf,dtype=dtype,count=size).reshape(shape)
+
+def PinBLAS(nthreads=1):
+    """
+    Limit BLAS to nthreads in the current process. The environment
+    variables only reach libraries loaded afterwards, so the ones numpy
+    has already loaded are set through threadpoolctl or their own API.
+    """
+    for key in BLAS_THREADS: os.environ[key] = str(nthreads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(nthreads)
+        return
+    except ImportError:
+        pass
+    try:
+        maps = open("/proc/self/maps").read().split()
+    except IOError:
+        return
+    for path in set(item for item in maps if "blas" in item or "mkl_rt" in item):
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for name in BLAS_SETTERS:
+            func = getattr(lib,name,None)
+            if func is not None: func(ctypes.c_int(nthreads))
+
+def _init_worker():
+    PinBLAS()
+    calc = _job[0]
+    # nor do the OpenMP threads of the Ewald kernels
+    if getattr(calc,"ecalc",None) != None: calc.ecalc.nthreads = 1
+
+def _worker(bounds):
+    calc,kpts,crys,evec,out = _job
+    start,stop = bounds
+    # one extra k-point on each side: the Ewald kernels use the neighbouring
+    # q-points to pick the direction of approach at Gamma
+    lo = max(start-1,0); hi = min(stop+1,len(kpts))
+    dyn = calc.build_dyn(kpts[lo:hi],crys)[start-lo:stop-lo]
+    freq,vec = calc.solve_dyn(dyn,evec=evec)
+    out[0][start:stop] = freq
+    if evec: out[1][start:stop] = vec
+    return bounds
+
+def ParallelSolver(calc,kpts,crys=True,nproc=None,chunk=None,evec=True):
+    """
+    Build and diagonalise the dynamical matrices at kpts in worker processes.
+    calc: VFFM or ABCM object
+        it has to provide build_dyn(kpts,crys), solve_dyn(dyn,evec) and nbnd;
+        the eigenvectors are complex unless calc.real_evec is True, i.e.,
+        solve_dyn gives real ones for the real matrices at Gamma
+    nproc: int
+        number of worker processes, default is the number of cores
+    chunk: int
+        number of k-points per task, default splits kpts into 4 tasks per worker
+    return: freq,evec
+        in the original order of kpts, backed by shared memory
+    """
+    global _job
+    kpts = np.asarray(kpts); nks = len(kpts)
+    if nproc == None: nproc = mp.cpu_count()
+    if chunk == None: chunk = max(1,-(-nks//(4*nproc)))
+    bounds = [(q,min(q+chunk,nks)) for q in range(0,nks,chunk)]
+    freq = SharedArray((nks,calc.nbnd))
+    # real eigenvectors for Gamma-only runs, see build_dyn
+    real = getattr(calc,"real_evec",False) and not np.any(kpts)
+    dtype = float if real else complex
+    vec = SharedArray((nks,calc.nbnd,calc.nbnd),dtype) if evec else None
+    _job = (calc,kpts,crys,evec,(freq,vec))
+    pool = mp.Pool(min(nproc,len(bounds)),initializer=_init_worker)
+    try:
+        pool.map(_worker,bounds,chunksize=1)
+    finally:
+        pool.close(); pool.join()
+        _job = None
+    return freq,vec
@@ -19,9 +19,40 @@ import numpy as np
 from numpy.linalg import inv,eigh,eig,norm
 from constants import M_THZ,TPI,KB,THZ_TO_J,THZ_TO_CM,THZ_TO_MEV
 from .ewald import Ewald
-from commonfunc import EigenSolver,MonkhorstPack,tetra_dos
+from commonfunc import EigenSolver,MonkhorstPack,tetra_dos,BondTable,\
+        SparseBlocks,SparseEigenSolver,BondOperator,BondPhase,BondAssemble,\
+        NeighbourSearch,ChunkSize
+from parallel import ParallelSolver
 from sys import exit
 
+def BondFC(x,d2,alpha,pairs,beta):
+    """
+    Construct the force constant tensors of many bonds at once.
+    x: ndarray of shape (nbonds,3)
+        bond vectors, atom - n.n.
+    d2: ndarray of shape (nbonds)
+        squared bond length the force constants are scaled by
+    alpha: ndarray of shape (nbonds)
+        bond-stretching force constants
+    pairs: tuple of int arrays j,k
+        pairs of bonds of the same atom for bond-bending, sorted by j
+    beta: ndarray of shape (npairs)
+        bond-bending force constants of the pairs
+    return: ndarray of shape (nbonds,3,3)
+    """
+    x,d2,alpha,beta = [np.asarray(item,dtype=float) for item in (x,d2,alpha,beta)]
+    j,k = pairs
+    Alpha = -np.einsum('na,nb,n->nab',x,x,alpha)
+    Beta = np.zeros_like(Alpha)
+    if len(j):
+        # j is sorted, so the pairs of each bond are contiguous
+        first = np.concatenate(([True],j[1:] != j[:-1]))
+        tmp = np.einsum('pa,pb,p->pab',x[j]+x[k],-x[k],beta)
+        Beta[j[first]] = np.add.reduceat(tmp,np.nonzero(first)[0])
+    Alpha *= (8/d2)[:,np.newaxis,np.newaxis]
+    Beta *= (2/d2)[:,np.newaxis,np.newaxis]
+    return Alpha+Beta
+
 def ConstructFC(alpha,beta,nn,atom):
     """
     Construct the force constant tensors according to nearest neighbours.
@@ -33,6 +64,8 @@ def ConstructFC(alpha,beta,nn,atom):
         bond-bending force constant
     nn: array of shape (N,3)
         all nearest neighbours in unit of lattice constant
+    atom: array of shape (3)
+        the centre atom
     return: ndarray of shape (N,3,3)
         tensors for all nearest neighbours
     """
@@ -40,62 +73,51 @@ def ConstructFC(alpha,beta,nn,atom):
     assert len(alpha) == N
     assert len(beta) == N
     assert len(beta[0]) == N
-    alpha,beta = map(np.array,(alpha,beta))
-
-    Alpha = np.zeros((N,3,3))
-    Beta = np.zeros((N,3,3))
-    d2 = np.dot(atom-nn[0],atom-nn[0])
-    one = np.ones((3,3))
-    
-    for n1 in range(N):
-        dvec = (atom-nn[n1]); tmp = dvec*one
-        Alpha[n1] = -np.multiply(tmp,tmp.T)*alpha[n1]
-        for n2 in range(N):
-            if n1 != n2:
-                dvec1 = (atom-nn[n2])
-                tmp1 = (dvec1+dvec)*one; tmp2 = -dvec1*one
-                Beta[n1] += np.multiply(tmp1.T,tmp2)*beta[n1,n2]
-    Alpha *= 8/d2
-    Beta *= 2/d2
+    beta = np.array(beta)
+    x = atom-np.asarray(nn)
+    j,k = np.nonzero(~np.identity(N,dtype=bool))
+    d2 = np.repeat(np.dot(x[0],x[0]),N)
+    return BondFC(x,d2,alpha,(j,k),beta[j,k])
 
-    return Alpha+Beta
-
-def DynBuild(basis,mass,bvec,fc,nn,label,kpts,crys=True):
+def DynBuild(bonds,mass,bvec,kpts,crys=True,sparse=False,gamma=False,backend=None):
     """
     Build the dynamical matrix from the short range force constant tensors.
-    basis: ndarray of shape (N,3)
+    bonds: BondTable
+        n.n. of all basis atoms with the force constant tensors fc set,
+        e.g., from ConstructFC. Unit ==> N/m
     mass: ndarray of shape (N)
         atomic unit, e.g, m(Si) = 28
     bvec: ndarray of shape (3,3)
         reciprocal lattice vectors
-    fc: list of array N*[fc_i], fc_i.shape = (len(nn_i),3,3)
-        force constant tensors, e.g., output from ConstructFC
-        Unit ==> N/m
-    nn: list of array, N*[nn_i], nn_i.shape = (len(nn_i),3)
-        positions of nearest neighbours
-    label: list of list, len(label) = N, len(label_i) = len(nn_i)
-        label of nearest neighbours in terms of no. of basis
     kpts: ndarray
         if crys: coordinates of reciprocal lattice vectors
         else: in terms of 2pi/alat
+    sparse: boolean
+        if True, return a list of scipy.sparse.csr_matrix, one for each
+        k-point, for large supercells, e.g., quantum dots
+    gamma: boolean
+        all kpts are Gamma, real float64 matrices are returned
+    backend: str
+        backend of the dense assembly, see backends
     """
     kpts = np.array(kpts)
     if kpts.shape == (3,): kpts = np.array([kpts])
-    assert len(basis) == len(mass)
-    N = len(mass); nks = len(kpts)
-    dyn = np.zeros((nks,N*3,N*3),dtype=complex)
+    assert bonds.N == len(mass)
+    mass = np.asarray(mass,dtype=float)
+    N = len(mass)
     # convert kpts to Cartesian coordinates if needed
     kpts = kpts.dot(bvec)*2.*np.pi if crys else kpts*2.*np.pi
-    for q in range(nks):
-        for i in range(N):
-            for j in range(len(nn[i])):
-                # With which atom?
-                x = basis[i]-nn[i][j]; ka = label[i][j]
-                mass_root = np.sqrt(mass[i]*mass[ka])
-                # ON-diagonal
-                dyn[q,i*3:i*3+3,i*3:i*3+3] -= fc[i][j]/mass[i]
-                # OFF-diagonal
-                dyn[q,i*3:i*3+3,ka*3:ka*3+3] += fc[i][j]/mass_root*np.exp(-1j*np.dot(kpts[q],x))
+    src = bonds.src; dst = bonds.dst; fcb = bonds.fc
+    # ON-diagonal, the same for all k-points
+    onsite = -fcb/mass[src].reshape(-1,1,1)
+    # OFF-diagonal, phases of all bonds at all k-points in one matrix product
+    offsite = fcb/np.sqrt(mass[src]*mass[dst]).reshape(-1,1,1)
+    phase = BondPhase(kpts,bonds.x,gamma) # shape = nks,nbonds
+    if sparse:
+        rows = np.concatenate((src,src)); cols = np.concatenate((src,dst))
+        return [SparseBlocks(np.concatenate((onsite,p.reshape(-1,1,1)*offsite)),\
+                rows,cols,N)*M_THZ for p in phase]
+    dyn = BondAssemble(onsite,offsite,src,dst,phase,N,backend=backend)
     # scale it to SI unit, omega^2 not frequency^2 after diagonalisation
     return dyn*M_THZ
 
@@ -111,6 +133,8 @@ class VFFM(object):
     symbol: string array or list, (N,)
         Element names of the basis, e.g., ["Si","Si"]
     """
+    # solve_dyn always uses eigh, so the eigenvectors are real at Gamma
+    real_evec = True
     def __init__(self,lvec,basis,mass,symbol):
         self.lvec,self.bas,self.mass,self.symbol =\
                     map(np.array,(lvec,basis,mass,symbol))
@@ -118,8 +142,6 @@ class VFFM(object):
         assert len(self.bas) == len(self.mass)
         assert len(symbol) == len(self.mass)
 
-        # initialise the force constant tensors
-        self.fc = []
         # initialise the k-points
         self.kpts = []
         # initialise the dynamical matrix
@@ -142,8 +164,24 @@ class VFFM(object):
         self.n2 = None
         # initiate Ewald object
         self.set_ewald()
+        # serial k-point loop unless set_parallel() is called
+        self.set_parallel(nproc=1)
 
-    def set_ewald(self,charge=[],eps=None,rgrid=[3,3,3],kgrid=[3,3,3]):
+    def set_parallel(self,nproc=None,chunk=None):
+        """
+        Build and diagonalise the dynamical matrices in worker processes.
+        nproc: int
+            number of processes, default is the number of cores;
+            nproc=1 switches back to the serial calculation
+        chunk: int
+            number of k-points per task
+        The dynamical matrices are not gathered in parallel runs, so
+        self.dyn is None afterwards.
+        """
+        self.nproc = nproc; self.kchunk = chunk
+
+    def set_ewald(self,charge=[],eps=None,rgrid=[3,3,3],kgrid=[3,3,3],accuracy=None,
+            method="ewald"):
         """
         ecalc: Ewald object
             Needed when one wants to have this long range interaction
@@ -152,6 +190,12 @@ class VFFM(object):
             of e^2/(4PI*epsilon*alat**3)
         rgrid,kgrid: list
             Meshes for Ewald calculation.
+        accuracy: float
+            if given, e.g., 1e-8, spherical meshes for the Ewald sums
+            are chosen for this accuracy instead of rgrid and kgrid
+        method: str
+            "ewald" or "spme" for the smooth particle-mesh Ewald, which is
+            cheaper for big supercells, see Ewald.get_dyn
         """
         if (charge != [] and eps == None) or (charge == [] and eps != None):
             raise ValueError("Both charge and eps should be given!")
@@ -159,7 +203,8 @@ class VFFM(object):
             self.ecalc = None; self.eps = None
         else:
             self.ecalc = Ewald(lvec=self.lvec, basis=self.bas, charge=charge, \
-                    rgrid=rgrid, kgrid=kgrid)
+                    rgrid=rgrid, kgrid=kgrid, accuracy=accuracy)
+            self.ecalc.method = method
             self.eps = eps
 
     def set_nn(self,scope=[1,1,1],nmax=20,dist2=None,showDist=False):
@@ -181,43 +226,72 @@ class VFFM(object):
             To inspect all bond-lengths of all n.n. upto nmax. Recommended
             when one wants to use 2nd n.n.
         """
-        X,Y,Z = scope
-        x,y,z = np.mgrid[-X:X+1, -Y:Y+1, -Z:Z+1]
-        x = x.reshape(-1); y = y.reshape(-1); z = z.reshape(-1)
-        xyz = np.asarray((x,y,z)).T; rgrid = xyz.dot(self.lvec) # fix this hidden bug
-        # allatoms = []
-        # for item in self.bas:
-        #     allatoms = item+rgrid if allatoms == [] \
-        #         else np.vstack((allatoms,item+rgrid))
-        # the most efficient way to get allatoms
-        allatoms = (self.bas.reshape(-1,1,3)+rgrid).reshape(-1,3)
-        self.label = []; self.nn = []; self.nndist = []
-        for i in range(self.N):
-            dist = norm(self.bas[i]-allatoms,axis=1)
-            nn_ind = dist.argsort()[1:nmax] # consider the first nmax n.n.
-            if showDist: print dist[nn_ind]
-            if dist2 == None:
-                # first_nn_ind = [item for item in nn_ind if \
-                #         abs(dist[item] - dist[nn_ind[0]])<1e-4]
-                mask = np.abs(dist[nn_ind]-dist[nn_ind[0]])<1e-4
-                first_nn_ind = nn_ind[mask]
-            else:
-                # if dist2 exisits, count till that distance
-                first_nn_ind = nn_ind[dist[nn_ind]<=dist2]
-
-            label = np.array(first_nn_ind)/len(rgrid)
-            nn = allatoms[first_nn_ind]
-            nndist = dist[first_nn_ind]
-            self.label.append(label)
-            self.nn.append(nn)
-            self.nndist.append(nndist)
-        self.nnsymb = []
-        for i in range(self.N):
-            self.nnsymb.append(self.symbol[self.label[i]])
+        # candidates of all atoms from one KD-tree query
+        alldist,allind,allatoms,nimg = NeighbourSearch(self.bas,self.lvec,scope,nmax)
+        if showDist:
+            for dist in alldist: print dist
+        if dist2 == None:
+            first_nn = np.abs(alldist-alldist[:,:1])<1e-4
+        else:
+            # if dist2 exisits, count till that distance
+            first_nn = alldist<=dist2
+        offsets = np.concatenate(([0],np.cumsum(first_nn.sum(axis=1))))
+        ind = allind[first_nn]
+        self.bonds = BondTable(self.bas,self.lvec,self.symbol,offsets,ind/nimg,allatoms[ind])
         # fill in 2nd n.n. information
         if dist2:
             self.n2 = [len(self.nn[i])-self.n1[i] for i in range(self.N)]
 
+    # per-atom views of self.bonds, e.g., self.nn[i] are the positions of
+    # the n.n. of atom i
+    @property
+    def nn(self):
+        return self.bonds.per_atom("nn")
+
+    @property
+    def label(self):
+        return self.bonds.per_atom("dst")
+
+    @property
+    def nndist(self):
+        return self.bonds.per_atom("dist")
+
+    @property
+    def nnsymb(self):
+        return self.bonds.per_atom("symb")
+
+    @property
+    def fc(self):
+        return [] if self.bonds.fc is None else self.bonds.per_atom("fc")
+
+    @fc.setter
+    def fc(self,fc):
+        if len(fc) == 0: self.bonds.fc = None
+        else: self.bonds.set_fc(fc)
+
+    def __setstate__(self,state):
+        # objects pickled before the bond table keep the per-atom lists nn,
+        # label and fc, and lack the settings added since
+        state = dict(state)
+        if "bonds" not in state:
+            for key in ("nndist","nnsymb"): state.pop(key,None)
+            fc = state.pop("fc",[])
+            state["bonds"] = BondTable.from_lists(state["bas"],state["lvec"],state["symbol"],\
+                    state.pop("nn"),state.pop("label"))
+            if len(fc) != 0: state["bonds"].set_fc(list(fc))
+        for key,value in (("nproc",1),("kchunk",None)):
+            state.setdefault(key,value)
+        self.__dict__.update(state)
+
+    def __bond_groups(self):
+        # 1 for the bonds beyond the first n.n. shell, and the index of the
+        # first bond of the group (shell) of each bond, whose length
+        # scales the force constants
+        b = self.bonds
+        n1 = np.asarray(self.n1)[b.src]
+        second = (np.arange(len(b))-b.offsets[b.src] >= n1).astype(int)
+        return second, b.offsets[b.src]+second*n1
+
     def set_bulk_fc(self,alpha,beta):
         '''
         Set the force constant tensors. Only two force constants needed:
@@ -226,12 +300,11 @@ class VFFM(object):
         beta: float
             bond-bending
         '''
-        self.fc = []
-        for i in range(self.N):
-            N = len(self.nn[i])
-            b = [beta]*N; bb = [b]*N
-            self.fc.append(ConstructFC \
-                ([alpha]*N,bb,self.nn[i],self.bas[i]))
+        b = self.bonds
+        j,k = b.pairs()
+        d2 = b.dist[b.offsets[b.src]]**2
+        self.fc = BondFC(b.x,d2,np.repeat(float(alpha),len(b)),(j,k),\
+                np.repeat(float(beta),len(j)))
 
     def set_bulk_fc2(self,alpha,beta):
         '''
@@ -241,18 +314,13 @@ class VFFM(object):
         beta: 2*[float]
             bond-bending
         '''
-        self.fc = []
-        a1,a2 = alpha; b1,b2 = beta
-        for i in range(self.N):
-            n1 = self.n1[i]
-            n2 = self.n2[i]
-            b = [b1]*n1; bb = [b]*n1
-            self.fc.append(ConstructFC \
-                ([a1]*n1,bb,self.nn[i][0:n1],self.bas[i]))
-            b = [b2]*n2; bb = [b]*n2
-            tmp = ConstructFC \
-                ([a2]*n2,bb,self.nn[i][n1::],self.bas[i])
-            self.fc[i] = np.vstack((self.fc[i],tmp))
+        b = self.bonds
+        second,first = self.__bond_groups()
+        j,k = b.pairs()
+        # bending only within the same shell
+        keep = second[j] == second[k]; j,k = j[keep],k[keep]
+        alpha,beta = map(np.array,(alpha,beta))
+        self.fc = BondFC(b.x,b.dist[first]**2,alpha[second],(j,k),beta[second[j]])
 
     def set_fc(self,fc_dict):
         '''
@@ -268,84 +336,48 @@ class VFFM(object):
         "Ga-As": 10.0, "Al-As": 11.0, "Ga-Ga2":1.0
         }
         The last one with a trailing 2 indicates a second n.n. interactions.
+        The bond-bending terms only couple bonds of the same shell, with the
+        average beta of the two bonds. A ValueError is raised if the alpha
+        of a bond, or the beta of a bond with another one in its shell, is
+        missing.
         '''
-        self.fc = []
         a_dict = fc_dict["alpha"]; b_dict = fc_dict["beta"]
-
-        for i in range(self.N):
-            onsite = self.symbol[i]
-            offsite = self.nnsymb[i]
-            nos = len(offsite)
-            alp = np.zeros(nos)
-            bet = np.zeros((nos,nos))
-            for j in range(nos):
-                key1 = onsite+"-"+offsite[j]
-                key2 = offsite[j]+"-"+onsite
-                if j >= self.n1[i]:
-                    key1 += "2"
-                    key2 += "2"
-                if a_dict.has_key(key1):
-                    key = key1
-                elif a_dict.has_key(key2):
-                    key = key2
-                else:
-                    raise ValueError("Missing interaction: "+key1)
-                alp[j] = a_dict[key]
-                tmp = []
-                for k in range(nos):
-                    if k != j:
-                        key3 = onsite+"-"+offsite[k]
-                        key4 = offsite[k]+"-"+onsite
-                        # print keys
-                        if j >= self.n1[i]:
-                            key3 += "2"
-                            key4 += "2"
-                        if b_dict.has_key(key3):
-                            key_b = key3
-                        elif b_dict.has_key(key4):
-                            key_b = key4
-                        else:
-                            # raise ValueError("Missing interaction: "+key3)
-                            pass
-                        if b_dict.has_key(key1):
-                            key_a = key1
-                        elif b_dict.has_key(key2):
-                            key_a = key2
-                        else:
-                            # raise ValueError("Missing interaction: "+key1)
-                            pass
-                        if (j < self.n1[i] and j < self.n1[i]) or (j >= self.n1[i] and j >= self.n1[i]):
-                            b_avg = (b_dict[key_b]+b_dict[key_a])*0.5
-                            tmp.append(b_avg)
-                        else:
-                            tmp.append(0.0)
-                    elif k==j:
-                        tmp.append(0.0)
-                #
-                bet[j] = tmp
-            #
-            self.fc.append(ConstructFC \
-                (alp,bet,self.nn[i],self.bas[i]))
+        b = self.bonds
+        names = [str(name) for name in b.names]; ns = len(names)
+        second = self.__bond_groups()[0]
+        # the parameters of each (onsite, offsite, shell), looked up once
+        alp = np.zeros(ns*ns*2); bet = np.zeros(ns*ns*2); missing = {}; bmissing = {}
+        for n in range(ns*ns*2):
+            item,shell = divmod(n,2); tail = "2" if shell else ""
+            onsite,offsite = names[item//ns],names[item%ns]
+            keys = [onsite+"-"+offsite+tail,offsite+"-"+onsite+tail]
+            found = [key for key in keys if a_dict.has_key(key)]
+            if found: alp[n] = a_dict[found[0]]
+            else: missing[n] = keys[0]
+            found = [key for key in keys if b_dict.has_key(key)]
+            if found: bet[n] = b_dict[found[0]]
+            else: bmissing[n] = keys[0]
+        on = b.codes[b.src]
+        combo = (on*ns+b.species)*2+second
+        for n in np.unique(combo):
+            if n in missing: raise ValueError("Missing interaction: "+missing[n])
+        j,k = b.pairs()
+        # bending only within the same shell, see set_bulk_fc2; the pairs
+        # come both ways, so combo[j] covers the groups of all of them
+        keep = second[j] == second[k]; j,k = j[keep],k[keep]
+        for n in np.unique(combo[j]):
+            if n in bmissing: raise ValueError("Missing interaction: "+bmissing[n])
+        beta = 0.5*(bet[combo[k]]+bet[combo[j]])
+        d2 = b.dist[b.offsets[b.src]]**2
+        self.fc = BondFC(b.x,d2,alp[combo],(j,k),beta)
         # self.fix_interface()
 
     def fix_interface(self):
-        # Average the interface connection for set_fc()
-        for i in range(self.N):
-            # print "Checking atom ",i
-            for j in range(len(self.nn[i])):
-                bond0 = self.bas[i] - self.nn[i][j]
-                offsiteLabel = self.label[i][j]
-                for k in range(len(self.nn[offsiteLabel])):
-                    bond1 = self.bas[offsiteLabel] - self.nn[offsiteLabel][k]
-                    if np.allclose(bond0,-bond1): # the same bond
-                        tmp = self.fc[i][j] + self.fc[offsiteLabel][k].T
-                        # if np.allclose(self.fc[i][j],self.fc[offsiteLabel][k].T):
-                        #     print self.symbol[i]," with ", self.nnsymb[i][j], " is fine"
-                        # else:
-                        #     print self.symbol[i]," with ", self.nnsymb[i][j], " is not fine"
-                        tmp *= 0.5
-                        self.fc[i][j] = tmp
-                        self.fc[offsiteLabel][k] = tmp.T
+        # Average the interface connection for set_fc(), i.e., the fc of
+        # each bond and the transpose of that of its reverse bond
+        fc = self.bonds.fc
+        rev = self.bonds.reverse(); both = rev >= 0
+        fc[both] = 0.5*(fc[both]+np.swapaxes(fc[rev[both]],1,2))
 
     def set_kpts(self,kpts,crys=True):
         """
@@ -398,8 +430,7 @@ class VFFM(object):
             raise ValueError("Force constants not set yet!")
         elif self.kpts == []:
             raise ValueError("Kpts not set yet!")
-        self.dyn = DynBuild(self.bas,self.mass,self.bvec,self.fc,\
-                self.nn,self.label,self.kpts,crys=self.iskcrys)
+        self.dyn = DynBuild(self.bonds,self.mass,self.bvec,self.kpts,crys=self.iskcrys)
 
     def get_dyn(self):
         """
@@ -412,17 +443,89 @@ class VFFM(object):
         else:
             raise ValueError("No dynamical matrix!")
 
-    def get_ph_disp(self):
+    def get_ph_disp(self,evec=True):
         """
         get the phonon band structure of the system provided all
         force constans and kpts are specified. Return phonon frequencies.
+        evec: boolean
+            if False, eigenvectors are skipped and self.evec is None
         """
-        self.__set_dyn()
+        if self.fc == []:
+            raise ValueError("Force constants not set yet!")
+        elif self.kpts == []:
+            raise ValueError("Kpts not set yet!")
+        if self.nproc != 1:
+            self.dyn = None
+            self.freq,self.evec = ParallelSolver(self,self.kpts,self.iskcrys,\
+                    nproc=self.nproc,chunk=self.kchunk,evec=evec)
+        else:
+            self.dyn = self.build_dyn(self.kpts,self.iskcrys)
+            self.freq,self.evec = self.solve_dyn(self.dyn,evec=evec)
+        return self.freq
+
+    def build_dyn(self,kpts,crys=True):
+        """
+        Return the dynamical matrix, short range plus Ewald, at kpts
+        without touching self.kpts and self.dyn. It is real if all kpts
+        are Gamma, so that the real symmetric eigensolver is used.
+        """
+        gamma = not np.any(kpts)
+        dyn = DynBuild(self.bonds,self.mass,self.bvec,kpts,crys=crys,gamma=gamma)
+        if self.ecalc != None:
+            dyn += self.eps*self.ecalc.get_dyn(self.mass,kpts,crys=crys,gamma=gamma)
+        return dyn
+
+    def solve_dyn(self,dyn,evec=True):
+        """
+        Diagonalise a stack of dynamical matrices. Return freq,evec.
+        """
+        return EigenSolver(dyn,evec=evec)
+
+    def get_ph_sparse(self,nev=20,sigma=None,window=None,evec=True):
+        """
+        Phonons of large supercells from sparse dynamical matrices with
+        shift-invert ARPACK. Only a few modes are computed at each k-point.
+        nev: int
+            number of modes closest to sigma
+        sigma: float
+            in THz, by default the lowest nev modes are computed
+        window: tuple (fmin,fmax)
+            all modes within the window in THz instead
+        return: list of frequencies at each k-point, see SparseEigenSolver
+        """
+        if self.fc == []:
+            raise ValueError("Force constants not set yet!")
+        elif self.kpts == []:
+            raise ValueError("Kpts not set yet!")
         if self.ecalc != None:
-            self.dyn += self.eps*self.ecalc.get_dyn(self.mass,self.kpts,crys=self.iskcrys)
-        self.freq,self.evec = EigenSolver(self.dyn,fldata=None)
+            raise ValueError("Ewald interaction is dense, use get_ph_disp instead!")
+        self.dyn = DynBuild(self.bonds,self.mass,self.bvec,self.kpts,crys=self.iskcrys,\
+                sparse=True,gamma=not np.any(self.kpts))
+        self.freq,self.evec = SparseEigenSolver(self.dyn,nev=nev,sigma=sigma,\
+                window=window,evec=evec)
         return self.freq
 
+    def get_dyn_operator(self,kpt,crys=True):
+        """
+        The short range dynamical matrix at a single k-point as a
+        scipy.sparse.linalg.LinearOperator, e.g., for Lanczos methods.
+        The bonds are applied directly, no matrix is formed.
+        kpt: array of 3
+        crys: boolean
+            True, for crystal coordinates [default]
+            False, in unit of 2pi/alat
+        """
+        from scipy.sparse.linalg import LinearOperator
+        if self.fc == []:
+            raise ValueError("Force constants not set yet!")
+        if self.ecalc != None:
+            raise ValueError("Ewald interaction is dense, use get_ph_disp instead!")
+        K = BondOperator(self.bonds,self.bvec,kpt,crys=crys)
+        scale = np.repeat(1./np.sqrt(self.mass),3)
+        matvec = lambda x: K(scale*np.ravel(x))*scale*M_THZ
+        dtype = complex if np.any(kpt) else float
+        return LinearOperator((self.nbnd,self.nbnd),matvec=matvec,dtype=dtype)
+
     def get_nn_label(self):
         """
         Neatly print out all nearest neighbours for each base atom.
@@ -459,7 +562,7 @@ class VFFM(object):
 
         grid = MonkhorstPack(kgrid,withBoundary=True)
         self.set_kpts(grid,crys=True)
-        freq = np.sort(self.get_ph_disp())
+        freq = np.sort(self.get_ph_disp(evec=False))
 
         self.dos = tetra_dos(freq,kgrid,grid,self.N,nstep)
         np.savetxt("dos.csv", self.dos, delimiter=",",fmt="%10.5f")
@@ -585,7 +688,7 @@ class VFFM(object):
         # do a phonon calculation on the mesh
         grid = MonkhorstPack(kgrid,koff)
         self.set_kpts(grid,crys=True)
-        self.get_ph_disp()
+        self.get_ph_disp(evec=False)
         ph_e = self.freq.flatten()
         mask = ph_e<0.01 # truncated at 0.01THz
         ph_e += mask.astype(int)*0.01
@@ -638,9 +741,9 @@ class VFFM(object):
         self.k_conv(towhat='cart')
         kpts = np.copy(self.kpts)
         self.set_kpts(kpts+dk,crys=False)
-        self.get_ph_disp(); freq1 = np.sort(self.freq)
+        self.get_ph_disp(evec=False); freq1 = np.sort(self.freq)
         self.set_kpts(kpts,crys=False)
-        self.get_ph_disp(); freq0 = np.sort(self.freq)
+        self.get_ph_disp(evec=False); freq0 = np.sort(self.freq)
         df = (freq1-freq0)
         return df/norm(dk)
 
@@ -710,6 +813,7 @@ class VFFM(object):
         self.set_kpts(kpts,crys=crys)
         self.src_freq = np.sort(src_freq)
         assert len(self.src_freq) == self.nkpt
+        self.__set_fit_basis(self.set_bulk_fc,2)
         if self.ecalc != None:
             self.m_ewald = self.ecalc.get_dyn(self.mass,kpts,crys=crys)
             res = minimize(self.__fit_ewald,x0=np.array([a0,b0,eps0]),method=method)
@@ -727,23 +831,46 @@ class VFFM(object):
             self.set_bulk_fc(a,b)
             print "Fitted frequencies:"
             print np.sort(self.get_ph_disp())
+        self.fit_fc = self.fit_dyn = None
         if not res.success: print res.message
         self.__log_fit(res,filename="log_fit.txt")
         del minimize
 
+    def __set_fit_basis(self,set_fc,n):
+        # set_fc(*x) sets FCs linear in the n parameters x, and so are the
+        # dynamical matrices, so each step of the fit is a weighted sum of
+        # those of the unit parameters at the fit k-points. They are kept if
+        # they fit in memory, otherwise only the FCs.
+        self.fit_fc = np.zeros((n,len(self.bonds),3,3))
+        for i,unit in enumerate(np.identity(n)):
+            set_fc(*unit); self.fit_fc[i] = self.bonds.fc
+        self.fit_dyn = None
+        if ChunkSize(3*self.N) >= n*self.nkpt:
+            self.fit_dyn = np.zeros((n,self.nkpt,3*self.N,3*self.N),dtype=complex)
+            for i,unit in enumerate(self.fit_fc):
+                self.fc = unit
+                self.fit_dyn[i] = DynBuild(self.bonds,self.mass,self.bvec,self.kpts,\
+                        crys=self.iskcrys)
+
+    def __fit_dyn(self,x):
+        # short range dynamical matrices at the fit k-points for parameters x
+        if self.fit_dyn is None:
+            self.fc = np.tensordot(x,self.fit_fc,1)
+            return DynBuild(self.bonds,self.mass,self.bvec,self.kpts,crys=self.iskcrys)
+        return np.tensordot(x,self.fit_dyn,1)
+
     def __fit_no_ewald(self,ab0):
         a0,b0 = abs(ab0)
         print "alpha = %10.6f; beta = %10.6f" % (a0,b0)
-        self.set_bulk_fc(a0,b0)
-        freq = np.sort(self.get_ph_disp())
+        freq,evec = EigenSolver(self.__fit_dyn([a0,b0]),evec=False)
+        freq = np.sort(freq)
         return ((freq-self.src_freq)**2).sum()/len(freq)
 
     def __fit_ewald(self,abe0):
         a0,b0,eps0 = abs(abe0)
         print "alpha = %10.6f; beta = %10.6f; eps = %10.6f" % (a0,b0,eps0)
-        self.set_bulk_fc(a0,b0); self.__set_dyn()
-        dyn = eps0*self.m_ewald + self.get_dyn()
-        freq,evec = EigenSolver(dyn,fldata=None)
+        dyn = eps0*self.m_ewald + self.__fit_dyn([a0,b0])
+        freq,evec = EigenSolver(dyn,evec=False)
         freq = np.sort(freq)
         return ((freq-self.src_freq)**2).sum()/len(freq)
 
@@ -760,6 +887,7 @@ class VFFM(object):
         self.set_kpts(kpts,crys=crys)
         self.src_freq = np.sort(src_freq)
         assert len(self.src_freq) == self.nkpt
+        self.__set_fit_basis(lambda a0,b0,a1,b1: self.set_bulk_fc2([a0,a1],[b0,b1]),4)
         if self.ecalc != None:
             self.m_ewald = self.ecalc.get_dyn(self.mass,kpts,crys=crys)
             res = minimize(self.__fit_ewald2,x0=np.array([a0,b0,a1,b1,eps0]),method=method)
@@ -777,6 +905,7 @@ class VFFM(object):
             self.set_bulk_fc2([a,a1],[b,b1])
             print "Fitted frequencies:"
             print np.sort(self.get_ph_disp())
+        self.fit_fc = self.fit_dyn = None
         if not res.success: print res.message
         self.__log_fit(res,filename="log_fit2.txt")
         del minimize
@@ -784,16 +913,15 @@ class VFFM(object):
     def __fit_no_ewald2(self,x0):
         a0,b0,a1,b1 = abs(x0)
         print "alpha = %10.6f; beta = %10.6f; alpha1 = %10.6f; beta1 = %10.6f" % (a0,b0,a1,b1)
-        self.set_bulk_fc2([a0,a1],[b0,b1])
-        freq = np.sort(self.get_ph_disp())
+        freq,evec = EigenSolver(self.__fit_dyn([a0,b0,a1,b1]),evec=False)
+        freq = np.sort(freq)
         return ((freq-self.src_freq)**2).sum()/len(freq)
 
     def __fit_ewald2(self,x0):
         a0,b0,a1,b1,eps0 = abs(x0)
         print "alpha = %10.6f; beta = %10.6f; alpha1 = %10.6f; beta1 = %10.6f;eps = %10.6f" % (a0,b0,a1,b1,eps0)
-        self.set_bulk_fc2([a0,a1],[b0,b1]); self.__set_dyn()
-        dyn = eps0*self.m_ewald + self.get_dyn()
-        freq,evec = EigenSolver(dyn,fldata=None)
+        dyn = eps0*self.m_ewald + self.__fit_dyn([a0,b0,a1,b1])
+        freq,evec = EigenSolver(dyn,evec=False)
         freq = np.sort(freq)
         return ((freq-self.src_freq)**2).sum()/len(freq)
 